@@ -1,12 +1,17 @@
+import hashlib
 import json
 import sys
 from pathlib import Path
 
+import requests
+
 
 def generate_latest_model_file(tag: str):
     """
     Generate a latest.json file that points to the GitHub release for the given tag,
-    including direct links to the model assets.
+    including direct links to the model assets and their SHA-256 checksums.
+    The release must already be published, since the assets are downloaded
+    to compute the checksums.
     """
     owner = "neanes"
     repo = "byzantine-chant-ocr"
@@ -14,18 +19,33 @@ def generate_latest_model_file(tag: str):
     base_release_url = f"https://github.com/{owner}/{repo}/releases/tag/{tag}"
     base_asset_url = f"https://github.com/{owner}/{repo}/releases/download/{tag}"
 
+    assets = {
+        "model": f"{base_asset_url}/current_model.onnx",
+        "metadata": f"{base_asset_url}/metadata.json",
+    }
+
     data = {
         "latest_release": tag,
         "release_url": base_release_url,
-        "assets": {
-            "model": f"{base_asset_url}/current_model.onnx",
-            "metadata": f"{base_asset_url}/metadata.json",
-        },
+        "assets": assets,
+        "checksums": {name: url_sha256(url) for name, url in assets.items()},
     }
 
     print(json.dumps(data, indent=2))
 
 
+def url_sha256(url: str):
+    sha256 = hashlib.sha256()
+
+    with requests.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+
+        for chunk in response.iter_content(1024 * 1024):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("Usage: python generate_latest_json.py <tag>")
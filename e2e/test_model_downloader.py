@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.append("../src")
+
+import model_downloader
+from model_downloader import (
+    ChecksumError,
+    download_file,
+    download_latest_model,
+    ensure_current_model,
+    get_current_model,
+)
+
+MODEL = os.urandom(3 * 1024 * 1024 + 123)
+METADATA = json.dumps({"classes": ["ison", "oligon"]}).encode("utf-8")
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of the server, honoring Range requests. The server's
+    drops list gives the number of bytes to send before dropping the
+    connection on each request, and its errors list the statuses to fail with.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+
+        if self.path == "/latest.json":
+            body = json.dumps(self.server.latest_info).encode("utf-8")
+            self.send_body(200, body, {})
+            return
+
+        if self.server.errors:
+            self.send_body(self.server.errors.pop(0), b"", {})
+            return
+
+        data = self.server.files[self.path]
+        start = 0
+        status = 200
+        headers = {}
+
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") : -1])
+
+            if start >= len(data):
+                self.send_body(416, b"", {"Content-Range": f"bytes */{len(data)}"})
+                return
+
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+
+        body = data[start:]
+        drop = self.server.drops.pop(0) if self.server.drops else None
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+
+        if drop is None:
+            self.wfile.write(body)
+        else:
+            self.wfile.write(body[:drop])
+            self.close_connection = True
+
+    def send_body(self, status, body, headers):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Record the delays between retries instead of waiting
+    server_delays = []
+    monkeypatch.setattr(model_downloader.time, "sleep", server_delays.append)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    server.files = {"/model.onnx": MODEL, "/metadata.json": METADATA}
+    server.requests = []
+    server.drops = []
+    server.errors = []
+    server.delays = server_delays
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.url = url
+    server.latest_info = {
+        "latest_release": "model/v1.0.0",
+        "assets": {
+            "model": f"{url}/model.onnx",
+            "metadata": f"{url}/metadata.json",
+        },
+        "checksums": {
+            "model": hashlib.sha256(MODEL).hexdigest(),
+            "metadata": hashlib.sha256(METADATA).hexdigest(),
+        },
+    }
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_resumes_after_dropped_connection(server, tmp_path):
+    server.drops = [500000, 500000]
+
+    path = tmp_path / "model.onnx"
+    checksum = download_file(f"{server.url}/model.onnx", path)
+
+    assert path.read_bytes() == MODEL
+    assert checksum == hashlib.sha256(MODEL).hexdigest()
+
+    # Each retry continues from the end of the partial file
+    ranges = [r for _, r in server.requests]
+    offsets = [int(r[len("bytes=") : -1]) for r in ranges[1:]]
+
+    assert ranges[0] is None
+    assert len(offsets) == 2
+    assert 0 < offsets[0] < offsets[1]
+
+
+def test_download_resumes_partial_file(server, tmp_path):
+    path = tmp_path / "model.onnx"
+    path.write_bytes(MODEL[:2048])
+
+    download_file(f"{server.url}/model.onnx", path)
+
+    assert path.read_bytes() == MODEL
+    assert server.requests == [("/model.onnx", "bytes=2048-")]
+
+
+def test_download_of_complete_partial_file(server, tmp_path):
+    path = tmp_path / "model.onnx"
+    path.write_bytes(MODEL)
+
+    checksum = download_file(f"{server.url}/model.onnx", path)
+
+    assert checksum == hashlib.sha256(MODEL).hexdigest()
+
+
+def test_download_retries_server_errors(server, tmp_path):
+    server.errors = [503, 502]
+
+    path = tmp_path / "model.onnx"
+    download_file(f"{server.url}/model.onnx", path, backoff=0.5)
+
+    assert path.read_bytes() == MODEL
+    assert len(server.requests) == 3
+    assert server.delays == [0.5, 1.0]
+
+
+def test_download_gives_up_after_retries(server, tmp_path):
+    server.errors = [503] * 3
+
+    with pytest.raises(model_downloader.requests.HTTPError):
+        download_file(f"{server.url}/model.onnx", tmp_path / "model.onnx", retries=2)
+
+    assert len(server.requests) == 3
+
+
+def test_download_does_not_retry_client_errors(server, tmp_path):
+    server.errors = [404]
+
+    with pytest.raises(model_downloader.requests.HTTPError):
+        download_file(f"{server.url}/model.onnx", tmp_path / "model.onnx")
+
+    assert len(server.requests) == 1
+
+
+def test_download_latest_model_reports_progress(server, tmp_path):
+    server.drops = [500000]
+    progress = []
+
+    tag = download_latest_model(
+        tmp_path,
+        f"{server.url}/latest.json",
+        progress=lambda *args: progress.append(args),
+    )
+
+    stored_model = get_current_model(tmp_path)
+
+    assert tag == "model/v1.0.0"
+    assert stored_model.model_path.read_bytes() == MODEL
+    assert stored_model.metadata_path.read_bytes() == METADATA
+    assert progress[-1] == ("metadata.json", len(METADATA), len(METADATA))
+    assert ("current_model.onnx", len(MODEL), len(MODEL)) in progress
+    assert not list((tmp_path / "store").glob(".download-*"))
+
+
+def test_download_latest_model_discards_corrupt_partial_files(server, tmp_path):
+    partial_dir = tmp_path / "store" / ".download-model_v1.0.0"
+    partial_dir.mkdir(parents=True)
+    (partial_dir / "current_model.onnx").write_bytes(b"x" * 1024)
+
+    with pytest.raises(ChecksumError):
+        download_latest_model(tmp_path, f"{server.url}/latest.json")
+
+    assert not partial_dir.exists()
+
+    download_latest_model(tmp_path, f"{server.url}/latest.json")
+
+    assert get_current_model(tmp_path).model_path.read_bytes() == MODEL
+
+
+def test_legacy_model_is_imported_without_a_connection(tmp_path):
+    legacy_dir = tmp_path / "latest"
+    legacy_dir.mkdir()
+    (legacy_dir / "current_model.onnx").write_bytes(MODEL)
+    (legacy_dir / "metadata.json").write_bytes(METADATA)
+
+    # Nothing listens on port 9, so a download would fail
+    stored_model = ensure_current_model(tmp_path, "http://127.0.0.1:9/latest.json")
+
+    assert stored_model.tag == "legacy"
+    assert stored_model.model_path.read_bytes() == MODEL
+    assert stored_model.metadata_path.read_bytes() == METADATA
+    assert get_current_model(tmp_path).path == stored_model.path
+    assert (legacy_dir / "current_model.onnx").exists()
@@ -1,10 +1,14 @@
 """
 ONNX conversion
 
-This script converts a PTH model into the ONNX format.
+This script converts a PTH model into the ONNX format. Optionally, it also
+produces an int8 model using static quantization, calibrated on a sample
+of data/dataset, and compares its accuracy to the fp32 model on the test split
+used by test.py. See quantize_onnx.py.
 """
 
 import argparse
+import random
 import sys
 
 import torch
@@ -63,8 +67,49 @@ if __name__ == "__main__":
         help="Relative path to the model's metatdata file",
         default="../models/metadata.json",
     )
+
+    parser.add_argument(
+        "--quantize",
+        help="Also produce an int8 model next to the output file",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--data",
+        help="Relative path to the dataset used for calibration and evaluation",
+        default="../data/dataset",
+    )
+
+    parser.add_argument(
+        "--calibration-size",
+        help="The number of training images used to calibrate the int8 model",
+        type=int,
+        default=1000,
+    )
+
     args = parser.parse_args()
     metadata = load_metadata(args.meta)
     model = load_model(args.i, metadata.classes)
 
     convert_to_onnx(model, args.o)
+
+    if args.quantize:
+        # The quantization helpers need OpenCV, which the
+        # conversion alone does not, so only import them here
+        from quantize_onnx import compare_accuracy, quantize_onnx, split_dataset
+
+        from model import get_quantized_model_path
+
+        train_samples, test_samples = split_dataset(args.data)
+
+        # Calibrate on training images only, so that the
+        # accuracy comparison uses images the model has never seen
+        calibration_samples = random.Random(0).sample(
+            train_samples, min(args.calibration_size, len(train_samples))
+        )
+
+        quantized_path = get_quantized_model_path(args.o)
+
+        quantize_onnx(args.o, quantized_path, [path for path, _ in calibration_samples])
+
+        compare_accuracy(args.o, quantized_path, test_samples)
@@ -0,0 +1,100 @@
+"""
+Startup time
+
+This script measures how long the app takes to start. It times
+`app.py --help`, which only parses the command line, and the import of each
+stack that the launch modes load on demand. It also lists the slowest
+imports of `app.py --help`.
+
+Usage: python measure_startup.py [--runs 5]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = "../src"
+
+# The modules each launch mode imports on demand
+STACKS = {
+    "headless": "import ocr",
+    "server": "import jobs, server",
+    "gui": "import gui",
+}
+
+
+def time_command(args, runs):
+    """
+    Returns the median wall time of a command in seconds
+    """
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=SRC_DIR, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def slowest_imports(args, count=10):
+    """
+    Returns the top-level imports of a command with the largest
+    cumulative import times, in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+    )
+
+    imports = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+
+        # Only report top-level imports
+        if name.startswith("  "):
+            continue
+
+        imports.append((int(cumulative), name.strip()))
+
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the startup time of app.py")
+
+    parser.add_argument(
+        "--runs",
+        help="The number of times to run each measurement",
+        type=int,
+        default=5,
+    )
+
+    args = parser.parse_args()
+
+    baseline = time_command([sys.executable, "-c", "pass"], args.runs)
+    print(f"python: {baseline * 1000:.0f} ms")
+
+    help_time = time_command([sys.executable, "app.py", "--help"], args.runs)
+    print(f"app.py --help: {help_time * 1000:.0f} ms")
+
+    for name, statement in STACKS.items():
+        try:
+            stack_time = time_command([sys.executable, "-c", statement], args.runs)
+            print(f"{name} imports: {stack_time * 1000:.0f} ms")
+        except subprocess.CalledProcessError:
+            print(f"{name} imports: not available")
+
+    print()
+    print("Slowest imports of app.py --help:")
+
+    for cumulative, name in slowest_imports(["app.py", "--help"]):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
@@ -0,0 +1,147 @@
+"""
+ONNX quantization
+
+This script contains the helpers convert_to_onnx.py uses for --quantize. They
+produce an int8 model using static quantization, calibrated on a sample of
+data/dataset, and compare its accuracy to the fp32 model on the test split
+used by test.py. They need OpenCV, so they are kept apart from the conversion,
+which runs in CI without it.
+"""
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from ImageFolderWithPaths import ImageFolderWithPaths
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quant_pre_process,
+    quantize_static,
+)
+
+sys.path.append("../src")
+from model import load_onnx_model, transform_batch
+
+
+def split_dataset(data_dir):
+    """
+    Returns the image paths and labels of the train and test splits.
+    The split is the same as the one used by train.py and test.py.
+    """
+    full_dataset = ImageFolderWithPaths(data_dir)
+
+    train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(
+        full_dataset,
+        [0.7, 0.15, 0.15],
+        generator=torch.Generator().manual_seed(255247200),
+    )
+
+    def samples(subset):
+        return [full_dataset.samples[i] for i in subset.indices]
+
+    return samples(train_dataset), samples(test_dataset)
+
+
+def load_images(paths, size=224):
+    """
+    Loads images the same way the OCR pipeline sees them:
+    as (N, 3, size, size) float32 tensors made from grayscale images
+    """
+    images = np.empty((len(paths), size, size), dtype=np.uint8)
+
+    for i, path in enumerate(paths):
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+        if image.shape != (size, size):
+            image = cv2.resize(image, (size, size), interpolation=cv2.INTER_CUBIC)
+
+        images[i] = image
+
+    return transform_batch(images)
+
+
+class CalibrationReader(CalibrationDataReader):
+    def __init__(self, paths, batch_size=32):
+        self.paths = paths
+        self.batch_size = batch_size
+        self.start = 0
+
+    def get_next(self):
+        if self.start >= len(self.paths):
+            return None
+
+        batch = self.paths[self.start : self.start + self.batch_size]
+        self.start += self.batch_size
+
+        return {"input": load_images(batch)}
+
+    def rewind(self):
+        self.start = 0
+
+
+def quantize_onnx(onnx_path, quantized_path, calibration_paths):
+    # Fold constants and infer shapes first, as recommended by onnxruntime
+    preprocessed_path = quantized_path + ".preprocessed"
+
+    quant_pre_process(onnx_path, preprocessed_path)
+
+    try:
+        quantize_static(
+            preprocessed_path,
+            quantized_path,
+            CalibrationReader(calibration_paths),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+    finally:
+        os.remove(preprocessed_path)
+
+
+def evaluate_onnx(model, samples, batch_size=64):
+    """
+    Returns the predicted class ids for the samples
+    and the time it took to classify them
+    """
+    predictions = []
+    elapsed = 0
+
+    for start in range(0, len(samples), batch_size):
+        batch = samples[start : start + batch_size]
+        tensor = load_images([path for path, _ in batch])
+
+        t = time.perf_counter()
+        output = model.run(["output"], {"input": tensor})
+        elapsed += time.perf_counter() - t
+
+        predictions.extend(np.argmax(output[0], axis=1).tolist())
+
+    return np.array(predictions), elapsed
+
+
+def compare_accuracy(onnx_path, quantized_path, test_samples):
+    labels = np.array([label for _, label in test_samples])
+
+    results = {}
+
+    for name, path in [("fp32", onnx_path), ("int8", quantized_path)]:
+        predictions, elapsed = evaluate_onnx(load_onnx_model(path), test_samples)
+        results[name] = predictions
+
+        accuracy = 100 * np.mean(predictions == labels)
+        throughput = len(test_samples) / elapsed
+
+        print(
+            f"{name}: accuracy {accuracy:.2f}%, {throughput:.1f} images/s ({os.path.getsize(path) / 1e6:.1f} MB)"
+        )
+
+    agreement = 100 * np.mean(results["fp32"] == results["int8"])
+    print(f"int8 agrees with fp32 on {agreement:.2f}% of the test split")
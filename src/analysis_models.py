@@ -1,4 +1,21 @@
+import numpy as np
+
+# The formats an analysis can be saved in. See ocr.save_analysis.
+OUTPUT_FORMATS = ["yaml", "json", "msgpack"]
+
+
 class ContourMatch:
+    __slots__ = (
+        "id",
+        "bounding_circle",
+        "bounding_rect",
+        "test_image",
+        "label",
+        "confidence",
+        "line",
+        "grouped",
+    )
+
     def __init__(self):
         self.id: int = -1
         self.bounding_circle: Circle | None = None
@@ -21,6 +38,156 @@ class ContourMatch:
         }
 
 
+class MatchTable:
+    """
+    Stores the matches of a page as parallel NumPy arrays, which takes far less
+    memory than a list of ContourMatch objects. Indexing or iterating over the table
+    yields lightweight, read-only MatchView objects. Test images are not stored.
+    """
+
+    def __init__(self, size=0):
+        self.id = np.full(size, -1, dtype=np.int64)
+        self.x = np.zeros(size, dtype=np.int64)
+        self.y = np.zeros(size, dtype=np.int64)
+        self.w = np.zeros(size, dtype=np.int64)
+        self.h = np.zeros(size, dtype=np.int64)
+        self.circle_x = np.zeros(size, dtype=np.float64)
+        self.circle_y = np.zeros(size, dtype=np.float64)
+        self.circle_r = np.zeros(size, dtype=np.float64)
+        self.line = np.full(size, -1, dtype=np.int64)
+        # Index into self.labels, or -1 if the match has no label
+        self.label_id = np.full(size, -1, dtype=np.int64)
+        self.confidence = np.zeros(size, dtype=np.float64)
+        self.labels: list[str] = []
+
+    @classmethod
+    def from_matches(cls, matches):
+        table = cls(len(matches))
+
+        label_ids = {}
+
+        for i, m in enumerate(matches):
+            table.id[i] = m.id
+            table.x[i] = m.bounding_rect.x
+            table.y[i] = m.bounding_rect.y
+            table.w[i] = m.bounding_rect.w
+            table.h[i] = m.bounding_rect.h
+            table.circle_x[i] = m.bounding_circle.x
+            table.circle_y[i] = m.bounding_circle.y
+            table.circle_r[i] = m.bounding_circle.r
+            table.line[i] = m.line
+            table.confidence[i] = m.confidence
+
+            if m.label is not None:
+                table.label_id[i] = label_ids.setdefault(m.label, len(label_ids))
+
+        table.labels = list(label_ids)
+
+        return table
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + len(self)
+
+        if index < 0 or index >= len(self):
+            raise IndexError("match index out of range")
+
+        return MatchView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield MatchView(self, i)
+
+    def to_dict(self):
+        """
+        Same as [m.to_dict() for m in table], but reads each column only once
+        """
+        return [
+            {
+                "id": id,
+                "label": self.labels[label_id] if label_id != -1 else None,
+                # Matches that were never classified have an integer confidence of 0
+                "confidence": confidence if label_id != -1 else 0,
+                "line": line,
+                "bounding_rect": {"x": x, "y": y, "w": w, "h": h},
+                "bounding_circle": {"x": cx, "y": cy, "r": r},
+            }
+            for id, label_id, confidence, line, x, y, w, h, cx, cy, r in zip(
+                self.id.tolist(),
+                self.label_id.tolist(),
+                self.confidence.tolist(),
+                self.line.tolist(),
+                self.x.tolist(),
+                self.y.tolist(),
+                self.w.tolist(),
+                self.h.tolist(),
+                self.circle_x.tolist(),
+                self.circle_y.tolist(),
+                self.circle_r.tolist(),
+            )
+        ]
+
+
+class MatchView:
+    """
+    A read-only view of one row of a MatchTable, with the same attributes as ContourMatch
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table: MatchTable, index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def id(self) -> int:
+        return self.table.id[self.index].item()
+
+    @property
+    def label(self) -> str | None:
+        label_id = self.table.label_id[self.index]
+        return self.table.labels[label_id] if label_id != -1 else None
+
+    @property
+    def confidence(self) -> float:
+        if self.table.label_id[self.index] == -1:
+            return 0
+
+        return self.table.confidence[self.index].item()
+
+    @property
+    def line(self) -> int:
+        return self.table.line[self.index].item()
+
+    @property
+    def bounding_rect(self):
+        t = self.table
+        i = self.index
+        return Rect((t.x[i].item(), t.y[i].item(), t.w[i].item(), t.h[i].item()))
+
+    @property
+    def bounding_circle(self):
+        t = self.table
+        i = self.index
+        return Circle(
+            ((t.circle_x[i].item(), t.circle_y[i].item()), t.circle_r[i].item())
+        )
+
+    @property
+    def test_image(self):
+        return None
+
+    @property
+    def grouped(self) -> bool:
+        return False
+
+    def to_dict(self):
+        return ContourMatch.to_dict(self)
+
+
 class PageAnalysis:
     def __init__(self):
         self.id = 0
@@ -30,6 +197,8 @@ class PageAnalysis:
         self.segmentation = None
         self.matches = []
         self.image_with_text_removed = None
+        # The key of the page in a PageCache, if one was used
+        self.cache_key = None
 
     def to_dict(self):
         result = {
@@ -43,7 +212,10 @@ class PageAnalysis:
             result["page_area"] = self.page_area
 
         result["segmentation"] = self.segmentation.to_dict()
-        result["matches"] = [x.to_dict() for x in self.matches]
+        if isinstance(self.matches, MatchTable):
+            result["matches"] = self.matches.to_dict()
+        else:
+            result["matches"] = [x.to_dict() for x in self.matches]
         result["interpreted_groups"] = [x.to_dict() for x in self.interpreted_groups]
 
         return result
@@ -56,16 +228,23 @@ class Analysis:
         self.additional_metadata = {}
         self.pages = []
 
-    def to_dict(self):
+    def header_to_dict(self):
         return {
             "schema_version": self.schema_version,
             "model_metadata": self.model_metadata.to_dict(),
             "additional_metadata": self.additional_metadata,
+        }
+
+    def to_dict(self):
+        return {
+            **self.header_to_dict(),
             "pages": [x.to_dict() for x in self.pages],
         }
 
 
 class Rect:
+    __slots__ = ("x", "y", "w", "h")
+
     def __init__(self, rect):
         x, y, w, h = rect
         self.x = x
@@ -83,6 +262,8 @@ class Rect:
 
 
 class Circle:
+    __slots__ = ("x", "y", "r")
+
     def __init__(self, circle):
         (x, y), r = circle
         self.x = x
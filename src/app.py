@@ -1,460 +1,411 @@
 import argparse
+import glob
+import json
+import multiprocessing
 import os
 import sys
-import traceback
-from pathlib import Path
-
-import cv2
-import pymupdf
-from PySide6.QtCore import QThread, Signal
-from PySide6.QtWidgets import (
-    QApplication,
-    QCheckBox,
-    QComboBox,
-    QFileDialog,
-    QHBoxLayout,
-    QLabel,
-    QLineEdit,
-    QMessageBox,
-    QPushButton,
-    QSpinBox,
-    QVBoxLayout,
-    QWidget,
+from concurrent.futures import as_completed
+
+from analysis_models import OUTPUT_FORMATS
+from datadir import get_model_dir
+from inference_options import (
+    EXECUTION_MODES,
+    GRAPH_OPTIMIZATION_LEVELS,
+    InferenceOptions,
 )
+from preprocess_options import DESKEW_STRATEGIES, PreprocessOptions
+
+# Only the modules needed to parse the command line are imported here.
+# The GUI and the OCR engine are slow to import, so each launch function
+# imports what it needs.
+
+# The options that can be set for each job in server and batch mode, and their types
+JOB_OPTIONS = {
+    "input": str,
+    "start_page": int,
+    "end_page": int,
+    "split_lr": bool,
+    "deskew": bool,
+    "deskew_max_angle": int,
+    "deskew_strategy": str,
+    "despeckle": bool,
+    "despeckle_ksize": int,
+    "close": bool,
+    "close_ksize": int,
+    "pdf_dpi": int,
+    "extract_pdf_images": bool,
+    "batch_size": int,
+    "format": str,
+    "keep_debug_images": bool,
+    # Only supported in batch mode
+    "output": str,
+}
+
+# The extension of batch outputs for each of OUTPUT_FORMATS
+BATCH_OUTPUT_EXTENSIONS = {"yaml": ".byzocr", "json": ".json", "msgpack": ".msgpack"}
+
+# The files that batch mode picks up from a directory or glob pattern
+BATCH_INPUT_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
 
-from model import load_onnx_model
-from model_downloader import download_latest_model
-from model_metadata import load_metadata
-from ocr import (
-    PreprocessOptions,
-    process_image,
-    process_pdf,
-    save_analysis,
-    write_analysis_to_stream,
-)
-from version import __version__
-
-
-class OCRThread(QThread):
-    error = Signal(str)
-    finished = Signal()
-
-    def __init__(
-        self,
-        infile_path,
-        output_path,
-        page_range,
-        model_path,
-        classes_path,
-        preprocess_options,
-        split_lr,
-        use_latest_model,
-    ):
-        super().__init__()
-        self.infile_path = infile_path
-        self.output_path = output_path
-        self.page_range = page_range
-        self.model_path = model_path
-        self.classes_path = classes_path
-        self.preprocess_options = preprocess_options
-        self.split_lr = split_lr
-        self.use_latest_model = use_latest_model
-
-    def run(self):
-        try:
-            if self.use_latest_model:
-                model_dir = get_model_dir()
-                self.classes_path = str(model_dir / "latest" / "metadata.json")
-                self.model_path = str(model_dir / "latest" / "current_model.onnx")
-
-                if not os.path.exists(self.classes_path) or not os.path.exists(
-                    self.model_path
-                ):
-                    download_latest_model(model_dir / "latest")
-
-            classes = load_metadata(self.classes_path)
-            model = load_onnx_model(self.model_path)
-
-            if self.infile_path.endswith(".pdf"):
-                analysis = process_pdf(
-                    self.infile_path,
-                    self.page_range,
-                    model,
-                    classes,
-                    preprocess_options=self.preprocess_options,
-                    split_lr=self.split_lr,
-                )
-            else:
-                image = cv2.imread(self.infile_path, cv2.IMREAD_GRAYSCALE)
-                analysis = process_image(
-                    image,
-                    model,
-                    classes,
-                    preprocess_options=self.preprocess_options,
-                    split_lr=self.split_lr,
-                )
 
-            analysis.additional_metadata["app_name"] = "Byzantine Chant OCR"
-            analysis.additional_metadata["app_version"] = __version__
-
-            save_analysis(analysis, self.output_path)
-            self.finished.emit()
-        except:
-            self.error.emit(traceback.format_exc())
-
-
-class UpdateModelThread(QThread):
-    error = Signal(str)
-    finished = Signal(str)
-
-    def __init__(self, path):
-        super().__init__()
-        self.path = path
-
-    def run(self):
-        try:
-            tag = download_latest_model(self.path)
-            self.finished.emit(tag)
-        except:
-            self.error.emit(traceback.format_exc())
-
-
-class MyWidget(QWidget):
-    def __init__(self):
-        super().__init__()
-
-        self.infile_path = ""
-
-        self.btnSelectInput = QPushButton("Select Input")
-        self.btnSelectInput.clicked.connect(self.choose_input_file)
-        self.lblSelectInput = QLabel("No file selected")
-        self.layoutSelectInput = QHBoxLayout()
-        self.layoutSelectInput.addWidget(self.btnSelectInput)
-        self.layoutSelectInput.addWidget(self.lblSelectInput)
-
-        self.chkUseLatestModel = QCheckBox("Use Latest Model", self)
-        self.chkUseLatestModel.setChecked(True)
-        self.chkUseLatestModel.stateChanged.connect(self.toggle_use_latest_model)
-        self.btnUpdateModel = QPushButton("Check for Model Updates")
-        self.btnUpdateModel.clicked.connect(self.update_model)
-
-        self.btnSelectModel = QPushButton("Select Model")
-        self.btnSelectModel.clicked.connect(self.choose_model)
-        self.txtSelectModel = QLineEdit("current_model.onnx")
-        self.txtSelectModel.setEnabled(False)
-        self.layoutSelectModel = QHBoxLayout()
-        self.layoutSelectModel.addWidget(self.btnSelectModel)
-        self.layoutSelectModel.addWidget(self.txtSelectModel)
-        self.widgetSelectModel = QWidget()
-        self.widgetSelectModel.setLayout(self.layoutSelectModel)
-        self.widgetSelectModel.setVisible(False)
-
-        self.btnSelectMetadata = QPushButton("Select Metadata")
-        self.btnSelectMetadata.clicked.connect(self.choose_metadata)
-        self.txtSelectMetadata = QLineEdit("metadata.json")
-        self.txtSelectMetadata.setEnabled(False)
-        self.layoutSelectMetadata = QHBoxLayout()
-        self.layoutSelectMetadata.addWidget(self.btnSelectMetadata)
-        self.layoutSelectMetadata.addWidget(self.txtSelectMetadata)
-        self.widgetSelectMetadata = QWidget()
-        self.widgetSelectMetadata.setLayout(self.layoutSelectMetadata)
-        self.widgetSelectMetadata.setVisible(False)
-
-        self.lblPages = QLabel("Pages")
-        self.txtPages = QLineEdit()
-        self.txtPages.setText("N/A")
-        self.txtPages.setEnabled(False)
-        self.layoutPages = QHBoxLayout()
-        self.layoutPages.addWidget(self.lblPages)
-        self.layoutPages.addWidget(self.txtPages)
-
-        self.chkTwoPageSpread = QCheckBox("Two-Page Spread", self)
-
-        self.layoutDeskew = QHBoxLayout()
-        self.chkDeskew = QCheckBox("Deskew", self)
-        self.lblDeskew = QLabel("max deg")
-        self.spnDeskew = QSpinBox(self)
-        self.spnDeskew.setMinimumWidth(50)
-        self.spnDeskew.setValue(5)
-        self.spnDeskew.setMinimum(1)
-        self.spnDeskew.setMaximum(90)
-        self.layoutDeskew.addWidget(self.chkDeskew)
-        self.layoutDeskew.addStretch()
-        self.layoutDeskew.addWidget(self.lblDeskew)
-        self.layoutDeskew.addWidget(self.spnDeskew)
-
-        self.layoutDespeckle = QHBoxLayout()
-        self.chkDespeckle = QCheckBox("Despeckle", self)
-        self.lblDespeckle = QLabel("k-size")
-        self.cmbDespeckle = QComboBox(self)
-        self.cmbDespeckle.setMinimumWidth(50)
-        self.cmbDespeckle.addItems(["3", "5", "7", "9"])
-        self.cmbDespeckle.setCurrentText("3")
-        self.layoutDespeckle.addWidget(self.chkDespeckle)
-        self.layoutDespeckle.addStretch()
-        self.layoutDespeckle.addWidget(self.lblDespeckle)
-        self.layoutDespeckle.addWidget(self.cmbDespeckle)
-
-        self.layoutClose = QHBoxLayout()
-        self.chkClose = QCheckBox("Close Holes", self)
-        self.lblClose = QLabel("k-size")
-        self.spnClose = QSpinBox(self)
-        self.spnClose.setMinimumWidth(50)
-        self.spnClose.setValue(2)
-        self.spnClose.setMinimum(2)
-        self.layoutClose.addWidget(self.chkClose)
-        self.layoutClose.addStretch()
-        self.layoutClose.addWidget(self.lblClose)
-        self.layoutClose.addWidget(self.spnClose)
-
-        self.btnGo = QPushButton("Go!", self)
-        self.btnGo.setEnabled(False)
-        # self.btnGo.setGeometry(150, 100, 100, 30)
-        self.btnGo.clicked.connect(self.go)
-
-        self.layout = QVBoxLayout(self)
-        # self.layout.addWidget(self.text)
-        self.layout.addLayout(self.layoutSelectInput)
-        self.layout.addLayout(self.layoutPages)
-        self.layout.addWidget(self.chkTwoPageSpread)
-        self.layout.addLayout(self.layoutDeskew)
-        self.layout.addLayout(self.layoutDespeckle)
-        self.layout.addLayout(self.layoutClose)
-        self.layout.addWidget(self.chkUseLatestModel)
-        self.layout.addWidget(self.btnUpdateModel)
-        self.layout.addWidget(self.widgetSelectModel)
-        self.layout.addWidget(self.widgetSelectMetadata)
-        self.layout.addWidget(self.btnGo)
-
-    def choose_input_file(self):
-        filepath, _ = QFileDialog.getOpenFileName(
-            self,
-            "Open File",
-            dir=str(Path.home()),
-            filter=(
-                "PDF and Images (*.pdf "
-                "*.bmp *.dib *.gif *.jpeg *.jpg *.jpe *.jp2 *.png *.webp *.avif "
-                "*.pbm *.pgm *.ppm *.pxm *.pnm *.pfm *.sr *.ras *.tiff *.tif *.exr *.hdr *.pic)"
-            ),
-        )
+def launch_normal():
+    from PySide6.QtWidgets import QApplication
 
-        if len(filepath) > 0:
-            self.lblSelectInput.setText(os.path.basename(filepath))
-            self.infile_path = filepath
-            self.btnGo.setEnabled(True)
-
-            if filepath.endswith(".pdf"):
-                doc = pymupdf.open(filepath)
-                self.page_count = len(doc)
-                self.txtPages.setText(f"1-{self.page_count}")
-                self.txtPages.setEnabled(True)
-            else:
-                self.txtPages.setEnabled(False)
-                self.txtPages.setText(f"N/A")
-
-    def choose_metadata(self):
-        filepath, _ = QFileDialog.getOpenFileName(
-            self, "Open File", dir=str(Path.home()), filter="JSON (*.json)"
-        )
+    from gui import MyWidget
+    from version import __version__
 
-        if len(filepath) > 0:
-            self.txtSelectMetadata.setText(filepath)
+    app = QApplication([])
 
-    def choose_model(self):
-        filepath, _ = QFileDialog.getOpenFileName(
-            self, "Open File", dir=str(Path.home()), filter="ONNX Model (*.onnx)"
-        )
+    widget = MyWidget()
+    widget.setWindowTitle(f"Byzantine Chant OCR v{__version__}")
+    # widget.resize(800, 600)
+    widget.show()
 
-        if len(filepath) > 0:
-            self.txtSelectModel.setText(filepath)
+    sys.exit(app.exec())
 
-    def go(self):
-        page_range = []
 
-        if self.infile_path.endswith(".pdf"):
-            try:
-                page_range = self.parse_page_range(self.txtPages.text())
-            except:
-                QMessageBox.critical(
-                    self,
-                    "Error",
-                    "Could not parse the page range.",
-                    buttons=QMessageBox.Ok,
-                    defaultButton=QMessageBox.Ok,
+def launch_headless(args):
+    import cv2
+
+    from model import load_onnx_model
+    from model_metadata import load_metadata
+    from ocr import (
+        AnalysisWriter,
+        process_image,
+        process_pdf,
+        process_pdf_parallel,
+        save_analysis,
+        write_analysis_to_stream,
+    )
+
+    if args.input is None:
+        print("Please specify an input file with -i or --input.")
+        sys.exit(1)
+
+    resolve_model_paths(args)
+
+    metadata = load_metadata(args.meta)
+
+    preprocess_options = create_preprocess_options(args)
+    inference_options = create_inference_options(args)
+    cache = create_page_cache(args)
+
+    if args.input.endswith(".pdf"):
+        if args.start_page == -1:
+            print("Please provide a page number with --start-page.")
+            sys.exit(1)
+
+        page_range = get_page_range(args)
+
+        def run_pdf(writer=None):
+            if args.workers > 1:
+                return process_pdf_parallel(
+                    args.input,
+                    page_range,
+                    args.model,
+                    metadata,
+                    preprocess_options=preprocess_options,
+                    split_lr=args.split_lr,
+                    inference_options=inference_options,
+                    workers=args.workers,
+                    writer=writer,
+                    cache=cache,
                 )
-                return
 
-        default_file_name = Path(self.infile_path).with_suffix(".byzocr")
+            # With several workers, only the workers load the model
+            model = load_onnx_model(args.model, inference_options)
+
+            return process_pdf(
+                args.input,
+                page_range,
+                model,
+                metadata,
+                preprocess_options=preprocess_options,
+                split_lr=args.split_lr,
+                inference_options=inference_options,
+                writer=writer,
+                cache=cache,
+            )
 
-        output_path, _ = QFileDialog.getSaveFileName(
-            self,
-            "Save File",
-            dir=str(default_file_name),
-            filter="BYZOCR (*.byzocr)",
-        )
+        if not args.stdout and args.format == "yaml":
+            # Write each page to the output file as soon as it is finished
+            with open(args.output, "w") as outfile:
+                writer = AnalysisWriter(outfile)
+                run_pdf(writer)
+                writer.close()
 
-        if len(output_path) == 0:
             return
 
-        self.enable_ui(False)
-
-        preprocess_options = PreprocessOptions()
-
-        preprocess_options.deskew = self.chkDeskew.isChecked()
-        preprocess_options.despeckle = self.chkDespeckle.isChecked()
-        preprocess_options.close = self.chkClose.isChecked()
-        preprocess_options.despeckle_kernel_size = int(self.cmbDespeckle.currentText())
-        preprocess_options.close_kernel_size = self.spnClose.value()
-        preprocess_options.deskew_max_angle = self.spnDeskew.value()
-
-        # Start OCR in a separate thread
-        self.thread = OCRThread(
-            self.infile_path,
-            output_path,
-            page_range,
-            self.txtSelectModel.text(),
-            self.txtSelectMetadata.text(),
-            preprocess_options,
-            self.chkTwoPageSpread.isChecked(),
-            self.chkUseLatestModel.isChecked(),
-        )
-        self.thread.error.connect(self.display_error)
-        self.thread.finished.connect(lambda: self.enable_ui(True))
-        self.thread.start()
-
-    def display_error(self, msg):
-        QMessageBox.critical(
-            self,
-            "Error",
-            msg,
-            buttons=QMessageBox.Ok,
-            defaultButton=QMessageBox.Ok,
+        results = run_pdf()
+    else:
+        image = cv2.imread(args.input, cv2.IMREAD_GRAYSCALE)
+        model = load_onnx_model(args.model, inference_options)
+        results = process_image(
+            image,
+            model,
+            metadata,
+            preprocess_options=preprocess_options,
+            split_lr=args.split_lr,
+            inference_options=inference_options,
+            cache=cache,
         )
 
-    def enable_ui(self, enabled):
-        self.btnGo.setEnabled(enabled)
-        self.btnSelectInput.setEnabled(enabled)
-        self.btnSelectMetadata.setEnabled(enabled)
-        self.btnSelectModel.setEnabled(enabled)
-        if self.infile_path.endswith(".pdf"):
-            self.txtPages.setEnabled(enabled)
-        self.chkTwoPageSpread.setEnabled(enabled)
-        self.chkDeskew.setEnabled(enabled)
-        self.chkDespeckle.setEnabled(enabled)
-        self.chkClose.setEnabled(enabled)
-        self.spnDeskew.setEnabled(enabled)
-        self.cmbDespeckle.setEnabled(enabled)
-        self.spnClose.setEnabled(enabled)
-        self.chkUseLatestModel.setEnabled(enabled)
-        self.btnUpdateModel.setEnabled(enabled)
-
-    def parse_page_range(self, page_range):
-        """
-        Parses a page range string (e.g., "1-5,7,9") into a list of zero-based integer indexes.
-
-        Args:
-            page_range (str): The range string, where ranges are specified as "start-end" and individual pages as numbers.
-
-        Returns:
-            list: A list of zero-based integer indexes.
-        """
-        indexes = []
-        # Split the input string by commas to handle multiple ranges/numbers
-        parts = page_range.split(",")
-
-        for part in parts:
-            # Check if the part specifies a range (e.g., "1-5")
-            if "-" in part:
-                start, end = map(int, part.split("-"))
-                indexes.extend(range(start - 1, end))  # Convert to zero-based indexes
-            else:
-                # Handle single page numbers
-                indexes.append(int(part) - 1)  # Convert to zero-based index
-
-        return sorted(indexes)  # Sort the final list
-
-    def update_model(self):
-        try:
-            self.enable_ui(False)
-
-            # Start Model Update in a separate thread
-            self.thread = UpdateModelThread(get_model_dir() / "latest")
-
-            def on_finished(tag):
-                QMessageBox.information(
-                    self,
-                    "Model Update",
-                    f"The latest model ({tag}) has been downloaded successfully.",
-                    buttons=QMessageBox.Ok,
-                    defaultButton=QMessageBox.Ok,
-                )
+    if args.stdout:
+        if args.format == "msgpack":
+            sys.stdout.buffer.write(write_analysis_to_stream(results, args.format))
+            sys.stdout.buffer.flush()
+        else:
+            print(
+                write_analysis_to_stream(results, args.format),
+                flush=True,
+            )
+    else:
+        save_analysis(results, args.output, args.format)
 
-                self.enable_ui(True)
 
-            def on_error(msg):
-                QMessageBox.critical(
-                    self,
-                    "Error",
-                    f"An error occurred while updating the model:\n{msg}",
-                    buttons=QMessageBox.Ok,
-                    defaultButton=QMessageBox.Ok,
-                )
+def launch_server(args):
+    from jobs import JobError
+    from server import OCRServer
+
+    resolve_model_paths(args)
+
+    # Options that a job does not set fall back to the server's options
+    defaults = vars(args)
+
+    def create_server_job(request):
+        if "output" in request:
+            raise JobError("The server returns the analysis. output is not supported.")
+
+        return create_job(request, defaults)
+
+    server = OCRServer(
+        (args.host, args.port),
+        create_server_job,
+        args.model,
+        args.meta,
+        create_inference_options(args),
+        workers=args.workers,
+    )
+
+    print(f"Listening on http://{args.host}:{args.port}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def launch_batch(args):
+    from jobs import JobError, create_job_executor, save_job_in_worker
+
+    resolve_model_paths(args)
 
-                self.enable_ui(True)
+    # Options that a file does not set fall back to the command line options
+    defaults = vars(args)
 
-            self.thread.error.connect(on_error)
-            self.thread.finished.connect(on_finished)
-            self.thread.start()
+    try:
+        jobs = [
+            create_job(request, defaults) for request in find_batch_requests(args.batch)
+        ]
+    except JobError as e:
+        print(e)
+        sys.exit(1)
 
-        except Exception as e:
-            QMessageBox.critical(
-                self,
-                "Error",
-                f"An error occurred while updating the model:\n{str(e)}",
-                buttons=QMessageBox.Ok,
-                defaultButton=QMessageBox.Ok,
+    for job in jobs:
+        if job.output is None:
+            job.output = get_batch_output_path(
+                job.input, job.output_format, args.output_dir
             )
 
-            self.enable_ui(True)
+    # Files with the same name in different folders would overwrite
+    # each other's output in --output-dir
+    inputs_by_output = {}
 
-    def toggle_use_latest_model(self, state):
-        if not state:
-            self.widgetSelectMetadata.show()
-            self.widgetSelectModel.show()
-            self.adjustSize()
-        else:
-            self.widgetSelectMetadata.hide()
-            self.widgetSelectModel.hide()
-            self.adjustSize()
+    for job in jobs:
+        inputs_by_output.setdefault(os.path.abspath(job.output), []).append(job.input)
 
+    duplicates = [inputs for inputs in inputs_by_output.values() if len(inputs) > 1]
 
-def launch_normal():
-    app = QApplication([])
+    if duplicates:
+        for inputs in duplicates:
+            print(
+                f"These files would be written to the same output: {', '.join(inputs)}"
+            )
 
-    widget = MyWidget()
-    widget.setWindowTitle(f"Byzantine Chant OCR v{__version__}")
-    # widget.resize(800, 600)
-    widget.show()
+        sys.exit(1)
 
-    sys.exit(app.exec())
+    pending = [job for job in jobs if args.force or not is_up_to_date(job)]
 
+    print(
+        f"Processing {len(pending)} of {len(jobs)} files. {len(jobs) - len(pending)} are up to date.",
+        flush=True,
+    )
 
-def launch_headless(args):
-    if args.input is None:
-        print("Please specify an input file with -i or --input.")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    failed = 0
+
+    with create_job_executor(
+        args.model, args.meta, create_inference_options(args), args.workers
+    ) as executor:
+        futures = {executor.submit(save_job_in_worker, job): job for job in pending}
+
+        for future in as_completed(futures):
+            job = futures[future]
+
+            try:
+                future.result()
+                print(f"{job.input} -> {job.output}", flush=True)
+            except Exception as e:
+                failed += 1
+                print(f"Failed to process {job.input}: {e}", flush=True)
+
+    if failed > 0:
+        print(f"{failed} files failed.")
         sys.exit(1)
 
+
+def create_job(request, defaults):
+    """
+    Creates an OCRJob from a dictionary of options. Options that are not in
+    the dictionary are taken from defaults, i.e. the command line arguments.
+    Raises a JobError if the options are invalid.
+    """
+    from jobs import JobError, OCRJob
+
+    if "input" not in request:
+        raise JobError("Please specify an input file with input.")
+
+    for key, value in request.items():
+        if key not in JOB_OPTIONS:
+            raise JobError(f"Unknown option {key}.")
+
+        option_type = JOB_OPTIONS[key]
+
+        # bool is a subclass of int, so check it separately
+        if not isinstance(value, option_type) or (
+            option_type is int and isinstance(value, bool)
+        ):
+            raise JobError(f"{key} must be of type {option_type.__name__}.")
+
+    job_args = argparse.Namespace(**{**defaults, **request})
+
+    if not os.path.isfile(job_args.input):
+        raise JobError(f"The input file {job_args.input} does not exist.")
+
+    if job_args.format not in OUTPUT_FORMATS:
+        raise JobError(f"format must be one of {', '.join(OUTPUT_FORMATS)}.")
+
+    if (
+        job_args.deskew_strategy is not None
+        and job_args.deskew_strategy not in DESKEW_STRATEGIES
+    ):
+        raise JobError(
+            f"deskew_strategy must be one of {', '.join(DESKEW_STRATEGIES)}."
+        )
+
+    job = OCRJob()
+    job.input = job_args.input
+    job.preprocess_options = create_preprocess_options(job_args)
+    job.inference_options = create_inference_options(job_args)
+    job.split_lr = job_args.split_lr
+    job.output_format = job_args.format
+    job.cache = create_page_cache(job_args)
+    # Only set per job, since every job needs its own output
+    job.output = request.get("output")
+
+    # If no start page is given, all pages of a PDF are processed
+    if job_args.input.endswith(".pdf") and job_args.start_page != -1:
+        job.page_range = get_page_range(job_args)
+
+    return job
+
+
+def find_batch_requests(source):
+    """
+    Returns the job options of each file in a batch. The source can be a
+    directory, a glob pattern, or a JSON manifest. A manifest is a list
+    whose items are either file paths or objects with the same options as
+    a server job, plus an optional output path. Relative paths in a manifest
+    are relative to the manifest.
+    """
+    from jobs import JobError
+
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+        return [{"input": path} for path in paths if is_batch_input(path)]
+
+    if os.path.isfile(source) and source.endswith(".json"):
+        with open(source) as f:
+            manifest = json.load(f)
+
+        if not isinstance(manifest, list):
+            raise JobError("The manifest must be a list of files.")
+
+        base_dir = os.path.dirname(source)
+        requests = []
+
+        for item in manifest:
+            if isinstance(item, str):
+                item = {"input": item}
+
+            if not isinstance(item, dict):
+                raise JobError("Each file in the manifest must be a path or an object.")
+
+            item = dict(item)
+
+            for key in ("input", "output"):
+                if isinstance(item.get(key), str):
+                    item[key] = os.path.join(base_dir, item[key])
+
+            requests.append(item)
+
+        return requests
+
+    paths = sorted(glob.glob(source, recursive=True))
+    return [{"input": path} for path in paths if is_batch_input(path)]
+
+
+def is_batch_input(path):
+    return os.path.isfile(path) and path.lower().endswith(BATCH_INPUT_EXTENSIONS)
+
+
+def get_batch_output_path(input_path, output_format="yaml", output_dir=None):
+    """
+    Returns the output path of a batch input. The input's extension is kept,
+    so that e.g. page.pdf and page.png get different outputs:
+    page.pdf.byzocr and page.png.byzocr.
+    """
+    path = input_path
+
+    if output_dir:
+        path = os.path.join(output_dir, os.path.basename(path))
+
+    return f"{path}{BATCH_OUTPUT_EXTENSIONS[output_format]}"
+
+
+def is_up_to_date(job):
+    """
+    Returns True if the job's output is newer than its input
+    """
+    return os.path.exists(job.output) and os.path.getmtime(
+        job.output
+    ) >= os.path.getmtime(job.input)
+
+
+def resolve_model_paths(args):
     if args.use_latest_model:
-        model_dir = get_model_dir()
-        args.model = str(model_dir / "latest" / "current_model.onnx")
-        args.meta = str(model_dir / "latest" / "metadata.json")
+        from model_downloader import ensure_current_model
 
-        if not os.path.exists(args.meta) or not os.path.exists(args.model):
-            download_latest_model(model_dir / "latest")
+        stored_model = ensure_current_model(get_model_dir())
+        args.model = str(stored_model.model_path)
+        args.meta = str(stored_model.metadata_path)
 
-    metadata = load_metadata(args.meta)
-    model = load_onnx_model(args.model)
 
+def create_preprocess_options(args):
     preprocess_options = PreprocessOptions()
 
     preprocess_options.deskew = args.deskew
@@ -470,69 +421,69 @@ def launch_headless(args):
     if args.deskew_max_angle:
         preprocess_options.deskew_max_angle = args.deskew_max_angle
 
-    if args.input.endswith(".pdf"):
-        if args.start_page == -1:
-            print("Please provide a page number with --start-page.")
-            sys.exit(1)
+    if args.deskew_strategy:
+        preprocess_options.deskew_strategy = args.deskew_strategy
 
-        start = args.start_page - 1
-        end = args.end_page - 1 if args.end_page != -1 else start
+    if args.pdf_dpi:
+        preprocess_options.pdf_dpi = args.pdf_dpi
 
-        page_range = range(start, end + 1)
+    preprocess_options.pdf_extract_images = args.extract_pdf_images
 
-        results = process_pdf(
-            args.input,
-            page_range,
-            model,
-            metadata,
-            preprocess_options=preprocess_options,
-            split_lr=args.split_lr,
-        )
-    else:
-        image = cv2.imread(args.input, cv2.IMREAD_GRAYSCALE)
-        results = process_image(
-            image,
-            model,
-            metadata,
-            preprocess_options=preprocess_options,
-            split_lr=args.split_lr,
-        )
+    return preprocess_options
 
-    if args.stdout:
-        print(
-            write_analysis_to_stream(results),
-            flush=True,
-        )
-    else:
-        save_analysis(results, args.output)
 
+def create_page_cache(args):
+    if args.cache_dir is None:
+        return None
 
-def get_datadir() -> Path:
-    """
-    Returns a parent directory path
-    where persistent application data can be stored.
-    """
+    from page_cache import PageCache
 
-    home = Path.home()
+    return PageCache(args.cache_dir, args.cache_size * 1024 * 1024)
 
-    if sys.platform == "win32":
-        return home / "AppData/Local" / "ByzantineChantOCR"
-    elif sys.platform == "linux":
-        return home / ".local/share" / "ByzantineChantOCR"
-    elif sys.platform == "darwin":
-        return home / "Library/Application Support" / "ByzantineChantOCR"
 
+def create_inference_options(args):
+    inference_options = InferenceOptions()
 
-def get_model_dir() -> Path:
+    if args.batch_size is not None:
+        inference_options.batch_size = args.batch_size
+
+    inference_options.quantized = args.quantized
+
+    if args.keep_debug_images:
+        inference_options.keep_debug_images = True
+
+    if args.threads is not None:
+        inference_options.intra_op_num_threads = args.threads
+
+    if args.inter_op_threads is not None:
+        inference_options.inter_op_num_threads = args.inter_op_threads
+
+    if args.execution_mode:
+        inference_options.execution_mode = args.execution_mode
+
+    if args.graph_optimization:
+        inference_options.graph_optimization_level = args.graph_optimization
+
+    if args.cache_optimized_model:
+        inference_options.cache_optimized_model = True
+
+    return inference_options
+
+
+def get_page_range(args):
     """
-    Returns the directory path
-    where models are stored.
+    Returns the zero-based range of pages to process
     """
+    start = args.start_page - 1
+    end = args.end_page - 1 if args.end_page != -1 else start
 
-    return get_datadir() / "models"
+    return range(start, end + 1)
 
 
 if __name__ == "__main__":
+    # Required for worker processes in the frozen (PyInstaller) app
+    multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(description="Performs OCR on an image or PDF")
 
     parser.add_argument(
@@ -565,6 +516,13 @@ if __name__ == "__main__":
         default="output.byzocr",
     )
 
+    parser.add_argument(
+        "--format",
+        help="The output format. json and msgpack use the same schema as the default yaml.",
+        choices=OUTPUT_FORMATS,
+        default="yaml",
+    )
+
     parser.add_argument(
         "--model",
         help="Relative path to the model",
@@ -607,6 +565,12 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "--deskew-strategy",
+        help="How to search for the skew angle. fast is much quicker, especially for large max angles.",
+        choices=DESKEW_STRATEGIES,
+    )
+
     parser.add_argument(
         "--despeckle",
         help="Use this flag if the image contains a lot of salt-and-pepper noise. Performs a median blur.",
@@ -631,9 +595,127 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "--pdf-dpi",
+        help="The highest DPI at which PDF pages are rendered (default 300). Large pages are rendered at the lower DPI that fits the maximum page size of 2550x3300.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--extract-pdf-images",
+        help="Use the embedded image of scanned PDF pages instead of rendering them. Pages that are not a single full-page image, or whose image has a lower resolution than the rendered page, are still rendered.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        help="The number of contours to classify at once. Use 0 to classify all contours on a page at once.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--quantized",
+        help="Use the int8 model next to the model file (e.g. current_model.int8.onnx) if it exists. Faster on CPUs, slightly less accurate.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--threads",
+        help="The number of threads used to run the model. By default, ONNX Runtime decides, or the cores are split between the workers when --workers is used.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--inter-op-threads",
+        help="The number of threads used to run independent parts of the model in parallel. Only used with --execution-mode parallel.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--execution-mode",
+        help="Whether ONNX Runtime runs the operators of the model sequentially or in parallel.",
+        choices=list(EXECUTION_MODES),
+    )
+
+    parser.add_argument(
+        "--graph-optimization",
+        help="How much ONNX Runtime optimizes the model graph. Defaults to all.",
+        choices=list(GRAPH_OPTIMIZATION_LEVELS),
+    )
+
+    parser.add_argument(
+        "--cache-optimized-model",
+        help="Save the optimized model next to the model file so that later runs load faster.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--keep-debug-images",
+        help="Keep the intermediate images of each page in memory. Uses much more memory on long documents.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache the intermediate results of each page in this folder, so that processing the same pages again only redoes the stages whose options or model changed",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        help="The maximum size of the cache in MB. The least recently used results are removed first.",
+        type=int,
+        default=1024,
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="The number of processes to use when processing PDF pages in parallel. With --serve, the number of jobs that can run at the same time.",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--serve",
+        help='Run a local HTTP server that keeps the model loaded and performs OCR on the jobs posted to /ocr. Each job is a JSON object with the same options as the command line, e.g. {"input": "book.pdf", "start_page": 1}. With --workers, up to that many jobs run at the same time.',
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--host",
+        help="The address the server listens on",
+        default="127.0.0.1",
+    )
+
+    parser.add_argument(
+        "--port",
+        help="The port the server listens on",
+        type=int,
+        default=8765,
+    )
+
+    parser.add_argument(
+        "--batch",
+        help='Process many files and write one output for each, named after the input plus the extension of --format, e.g. scan.pdf.byzocr or scan.pdf.json. Accepts a directory, a glob pattern (e.g. "scans/**/*.pdf"), or a JSON manifest listing the files, each optionally with its own page range and options. PDFs without a page range are processed in full. Files whose output is newer than the input are skipped. With --workers, that many files are processed at the same time.',
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        help="The directory where batch mode writes its output. By default, each output is written next to its input.",
+    )
+
+    parser.add_argument(
+        "--force",
+        help="In batch mode, process files even if their output is up to date",
+        action="store_true",
+    )
+
     args = parser.parse_args()
 
-    if args.headless:
+    if args.serve:
+        launch_server(args)
+    elif args.batch:
+        launch_batch(args)
+    elif args.headless:
         launch_headless(args)
     else:
         launch_normal()
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+
+def get_datadir() -> Path:
+    """
+    Returns a parent directory path
+    where persistent application data can be stored.
+    """
+
+    home = Path.home()
+
+    if sys.platform == "win32":
+        return home / "AppData/Local" / "ByzantineChantOCR"
+    elif sys.platform == "linux":
+        return home / ".local/share" / "ByzantineChantOCR"
+    elif sys.platform == "darwin":
+        return home / "Library/Application Support" / "ByzantineChantOCR"
+
+
+def get_model_dir() -> Path:
+    """
+    Returns the directory path
+    where models are stored.
+    """
+
+    return get_datadir() / "models"
@@ -3,6 +3,8 @@ from interpretation_options import InterpretationOptions
 
 
 class AugmentedContourMatch(ContourMatch):
+    __slots__ = ("is_base", "is_martyria", "is_kronos")
+
     def __init__(self, match: ContourMatch | None = None):
         super().__init__()
         self.is_base: bool = False
@@ -10,7 +12,8 @@ class AugmentedContourMatch(ContourMatch):
         self.is_kronos: bool = False
 
         if match is not None:
-            self.__dict__.update(match.__dict__)
+            for name in ContourMatch.__slots__:
+                setattr(self, name, getattr(match, name))
 
 
 class NeumeGroup:
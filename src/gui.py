@@ -0,0 +1,476 @@
+"""
+GUI
+
+This script contains the window of the app. It is only imported when the app
+is launched without --headless, so that headless runs do not need Qt.
+"""
+
+import os
+import traceback
+from pathlib import Path
+
+import cv2
+import pymupdf
+from PySide6.QtCore import QThread, Signal
+from PySide6.QtWidgets import (
+    QCheckBox,
+    QComboBox,
+    QFileDialog,
+    QHBoxLayout,
+    QLabel,
+    QLineEdit,
+    QMessageBox,
+    QProgressBar,
+    QPushButton,
+    QSpinBox,
+    QVBoxLayout,
+    QWidget,
+)
+
+from datadir import get_model_dir
+from model import load_onnx_model
+from model_downloader import download_latest_model, ensure_current_model
+from model_metadata import load_metadata
+from ocr import (
+    AnalysisWriter,
+    PreprocessOptions,
+    process_image,
+    process_pdf,
+    save_analysis,
+)
+from version import __version__
+
+
+class OCRThread(QThread):
+    error = Signal(str)
+    finished = Signal()
+    # filename, downloaded bytes, total bytes (0 if unknown)
+    download_progress = Signal(str, int, int)
+
+    def __init__(
+        self,
+        infile_path,
+        output_path,
+        page_range,
+        model_path,
+        classes_path,
+        preprocess_options,
+        split_lr,
+        use_latest_model,
+    ):
+        super().__init__()
+        self.infile_path = infile_path
+        self.output_path = output_path
+        self.page_range = page_range
+        self.model_path = model_path
+        self.classes_path = classes_path
+        self.preprocess_options = preprocess_options
+        self.split_lr = split_lr
+        self.use_latest_model = use_latest_model
+
+    def run(self):
+        try:
+            if self.use_latest_model:
+                stored_model = ensure_current_model(
+                    get_model_dir(), progress=self.report_download_progress
+                )
+                self.classes_path = str(stored_model.metadata_path)
+                self.model_path = str(stored_model.model_path)
+
+            classes = load_metadata(self.classes_path)
+            model = load_onnx_model(self.model_path)
+
+            if self.infile_path.endswith(".pdf"):
+                # Write each page to the output file as soon as it is finished
+                with open(self.output_path, "w") as outfile:
+                    writer = AnalysisWriter(outfile)
+                    writer.additional_metadata["app_name"] = "Byzantine Chant OCR"
+                    writer.additional_metadata["app_version"] = __version__
+
+                    process_pdf(
+                        self.infile_path,
+                        self.page_range,
+                        model,
+                        classes,
+                        preprocess_options=self.preprocess_options,
+                        split_lr=self.split_lr,
+                        writer=writer,
+                    )
+
+                    writer.close()
+            else:
+                image = cv2.imread(self.infile_path, cv2.IMREAD_GRAYSCALE)
+                analysis = process_image(
+                    image,
+                    model,
+                    classes,
+                    preprocess_options=self.preprocess_options,
+                    split_lr=self.split_lr,
+                )
+
+                analysis.additional_metadata["app_name"] = "Byzantine Chant OCR"
+                analysis.additional_metadata["app_version"] = __version__
+
+                save_analysis(analysis, self.output_path)
+
+            self.finished.emit()
+        except:
+            self.error.emit(traceback.format_exc())
+
+    def report_download_progress(self, filename, downloaded, total):
+        self.download_progress.emit(filename, downloaded, total or 0)
+
+
+class UpdateModelThread(QThread):
+    error = Signal(str)
+    finished = Signal(str)
+    # filename, downloaded bytes, total bytes (0 if unknown)
+    download_progress = Signal(str, int, int)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def run(self):
+        try:
+            tag = download_latest_model(
+                self.path, progress=self.report_download_progress
+            )
+            self.finished.emit(tag)
+        except:
+            self.error.emit(traceback.format_exc())
+
+    def report_download_progress(self, filename, downloaded, total):
+        self.download_progress.emit(filename, downloaded, total or 0)
+
+
+class MyWidget(QWidget):
+    def __init__(self):
+        super().__init__()
+
+        self.infile_path = ""
+
+        self.btnSelectInput = QPushButton("Select Input")
+        self.btnSelectInput.clicked.connect(self.choose_input_file)
+        self.lblSelectInput = QLabel("No file selected")
+        self.layoutSelectInput = QHBoxLayout()
+        self.layoutSelectInput.addWidget(self.btnSelectInput)
+        self.layoutSelectInput.addWidget(self.lblSelectInput)
+
+        self.chkUseLatestModel = QCheckBox("Use Latest Model", self)
+        self.chkUseLatestModel.setChecked(True)
+        self.chkUseLatestModel.stateChanged.connect(self.toggle_use_latest_model)
+        self.btnUpdateModel = QPushButton("Check for Model Updates")
+        self.btnUpdateModel.clicked.connect(self.update_model)
+
+        self.btnSelectModel = QPushButton("Select Model")
+        self.btnSelectModel.clicked.connect(self.choose_model)
+        self.txtSelectModel = QLineEdit("current_model.onnx")
+        self.txtSelectModel.setEnabled(False)
+        self.layoutSelectModel = QHBoxLayout()
+        self.layoutSelectModel.addWidget(self.btnSelectModel)
+        self.layoutSelectModel.addWidget(self.txtSelectModel)
+        self.widgetSelectModel = QWidget()
+        self.widgetSelectModel.setLayout(self.layoutSelectModel)
+        self.widgetSelectModel.setVisible(False)
+
+        self.btnSelectMetadata = QPushButton("Select Metadata")
+        self.btnSelectMetadata.clicked.connect(self.choose_metadata)
+        self.txtSelectMetadata = QLineEdit("metadata.json")
+        self.txtSelectMetadata.setEnabled(False)
+        self.layoutSelectMetadata = QHBoxLayout()
+        self.layoutSelectMetadata.addWidget(self.btnSelectMetadata)
+        self.layoutSelectMetadata.addWidget(self.txtSelectMetadata)
+        self.widgetSelectMetadata = QWidget()
+        self.widgetSelectMetadata.setLayout(self.layoutSelectMetadata)
+        self.widgetSelectMetadata.setVisible(False)
+
+        self.lblPages = QLabel("Pages")
+        self.txtPages = QLineEdit()
+        self.txtPages.setText("N/A")
+        self.txtPages.setEnabled(False)
+        self.layoutPages = QHBoxLayout()
+        self.layoutPages.addWidget(self.lblPages)
+        self.layoutPages.addWidget(self.txtPages)
+
+        self.chkTwoPageSpread = QCheckBox("Two-Page Spread", self)
+
+        self.layoutDeskew = QHBoxLayout()
+        self.chkDeskew = QCheckBox("Deskew", self)
+        self.lblDeskew = QLabel("max deg")
+        self.spnDeskew = QSpinBox(self)
+        self.spnDeskew.setMinimumWidth(50)
+        self.spnDeskew.setValue(5)
+        self.spnDeskew.setMinimum(1)
+        self.spnDeskew.setMaximum(90)
+        self.layoutDeskew.addWidget(self.chkDeskew)
+        self.layoutDeskew.addStretch()
+        self.layoutDeskew.addWidget(self.lblDeskew)
+        self.layoutDeskew.addWidget(self.spnDeskew)
+
+        self.layoutDespeckle = QHBoxLayout()
+        self.chkDespeckle = QCheckBox("Despeckle", self)
+        self.lblDespeckle = QLabel("k-size")
+        self.cmbDespeckle = QComboBox(self)
+        self.cmbDespeckle.setMinimumWidth(50)
+        self.cmbDespeckle.addItems(["3", "5", "7", "9"])
+        self.cmbDespeckle.setCurrentText("3")
+        self.layoutDespeckle.addWidget(self.chkDespeckle)
+        self.layoutDespeckle.addStretch()
+        self.layoutDespeckle.addWidget(self.lblDespeckle)
+        self.layoutDespeckle.addWidget(self.cmbDespeckle)
+
+        self.layoutClose = QHBoxLayout()
+        self.chkClose = QCheckBox("Close Holes", self)
+        self.lblClose = QLabel("k-size")
+        self.spnClose = QSpinBox(self)
+        self.spnClose.setMinimumWidth(50)
+        self.spnClose.setValue(2)
+        self.spnClose.setMinimum(2)
+        self.layoutClose.addWidget(self.chkClose)
+        self.layoutClose.addStretch()
+        self.layoutClose.addWidget(self.lblClose)
+        self.layoutClose.addWidget(self.spnClose)
+
+        self.btnGo = QPushButton("Go!", self)
+        self.btnGo.setEnabled(False)
+        # self.btnGo.setGeometry(150, 100, 100, 30)
+        self.btnGo.clicked.connect(self.go)
+
+        self.prgDownload = QProgressBar(self)
+        self.prgDownload.setVisible(False)
+
+        self.layout = QVBoxLayout(self)
+        # self.layout.addWidget(self.text)
+        self.layout.addLayout(self.layoutSelectInput)
+        self.layout.addLayout(self.layoutPages)
+        self.layout.addWidget(self.chkTwoPageSpread)
+        self.layout.addLayout(self.layoutDeskew)
+        self.layout.addLayout(self.layoutDespeckle)
+        self.layout.addLayout(self.layoutClose)
+        self.layout.addWidget(self.chkUseLatestModel)
+        self.layout.addWidget(self.btnUpdateModel)
+        self.layout.addWidget(self.widgetSelectModel)
+        self.layout.addWidget(self.widgetSelectMetadata)
+        self.layout.addWidget(self.btnGo)
+        self.layout.addWidget(self.prgDownload)
+
+    def choose_input_file(self):
+        filepath, _ = QFileDialog.getOpenFileName(
+            self,
+            "Open File",
+            dir=str(Path.home()),
+            filter=(
+                "PDF and Images (*.pdf "
+                "*.bmp *.dib *.gif *.jpeg *.jpg *.jpe *.jp2 *.png *.webp *.avif "
+                "*.pbm *.pgm *.ppm *.pxm *.pnm *.pfm *.sr *.ras *.tiff *.tif *.exr *.hdr *.pic)"
+            ),
+        )
+
+        if len(filepath) > 0:
+            self.lblSelectInput.setText(os.path.basename(filepath))
+            self.infile_path = filepath
+            self.btnGo.setEnabled(True)
+
+            if filepath.endswith(".pdf"):
+                doc = pymupdf.open(filepath)
+                self.page_count = len(doc)
+                self.txtPages.setText(f"1-{self.page_count}")
+                self.txtPages.setEnabled(True)
+            else:
+                self.txtPages.setEnabled(False)
+                self.txtPages.setText(f"N/A")
+
+    def choose_metadata(self):
+        filepath, _ = QFileDialog.getOpenFileName(
+            self, "Open File", dir=str(Path.home()), filter="JSON (*.json)"
+        )
+
+        if len(filepath) > 0:
+            self.txtSelectMetadata.setText(filepath)
+
+    def choose_model(self):
+        filepath, _ = QFileDialog.getOpenFileName(
+            self, "Open File", dir=str(Path.home()), filter="ONNX Model (*.onnx)"
+        )
+
+        if len(filepath) > 0:
+            self.txtSelectModel.setText(filepath)
+
+    def go(self):
+        page_range = []
+
+        if self.infile_path.endswith(".pdf"):
+            try:
+                page_range = self.parse_page_range(self.txtPages.text())
+            except:
+                QMessageBox.critical(
+                    self,
+                    "Error",
+                    "Could not parse the page range.",
+                    buttons=QMessageBox.Ok,
+                    defaultButton=QMessageBox.Ok,
+                )
+                return
+
+        default_file_name = Path(self.infile_path).with_suffix(".byzocr")
+
+        output_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save File",
+            dir=str(default_file_name),
+            filter="BYZOCR (*.byzocr)",
+        )
+
+        if len(output_path) == 0:
+            return
+
+        self.enable_ui(False)
+
+        preprocess_options = PreprocessOptions()
+
+        preprocess_options.deskew = self.chkDeskew.isChecked()
+        preprocess_options.despeckle = self.chkDespeckle.isChecked()
+        preprocess_options.close = self.chkClose.isChecked()
+        preprocess_options.despeckle_kernel_size = int(self.cmbDespeckle.currentText())
+        preprocess_options.close_kernel_size = self.spnClose.value()
+        preprocess_options.deskew_max_angle = self.spnDeskew.value()
+
+        # Start OCR in a separate thread
+        self.thread = OCRThread(
+            self.infile_path,
+            output_path,
+            page_range,
+            self.txtSelectModel.text(),
+            self.txtSelectMetadata.text(),
+            preprocess_options,
+            self.chkTwoPageSpread.isChecked(),
+            self.chkUseLatestModel.isChecked(),
+        )
+        self.thread.error.connect(self.display_error)
+        self.thread.finished.connect(lambda: self.enable_ui(True))
+        self.thread.download_progress.connect(self.show_download_progress)
+        self.thread.start()
+
+    def display_error(self, msg):
+        QMessageBox.critical(
+            self,
+            "Error",
+            msg,
+            buttons=QMessageBox.Ok,
+            defaultButton=QMessageBox.Ok,
+        )
+
+    def show_download_progress(self, filename, downloaded, total):
+        if total > 0:
+            # Use percentages, since QProgressBar only takes 32-bit values
+            self.prgDownload.setRange(0, 100)
+            self.prgDownload.setValue(downloaded * 100 // total)
+            self.prgDownload.setFormat(f"Downloading {filename}: %p%")
+        else:
+            self.prgDownload.setRange(0, 0)
+            self.prgDownload.setFormat(
+                f"Downloading {filename}: {downloaded / 1024 / 1024:.1f} MB"
+            )
+
+        self.prgDownload.setVisible(downloaded < total or total == 0)
+
+    def enable_ui(self, enabled):
+        if enabled:
+            self.prgDownload.setVisible(False)
+
+        self.btnGo.setEnabled(enabled)
+        self.btnSelectInput.setEnabled(enabled)
+        self.btnSelectMetadata.setEnabled(enabled)
+        self.btnSelectModel.setEnabled(enabled)
+        if self.infile_path.endswith(".pdf"):
+            self.txtPages.setEnabled(enabled)
+        self.chkTwoPageSpread.setEnabled(enabled)
+        self.chkDeskew.setEnabled(enabled)
+        self.chkDespeckle.setEnabled(enabled)
+        self.chkClose.setEnabled(enabled)
+        self.spnDeskew.setEnabled(enabled)
+        self.cmbDespeckle.setEnabled(enabled)
+        self.spnClose.setEnabled(enabled)
+        self.chkUseLatestModel.setEnabled(enabled)
+        self.btnUpdateModel.setEnabled(enabled)
+
+    def parse_page_range(self, page_range):
+        """
+        Parses a page range string (e.g., "1-5,7,9") into a list of zero-based integer indexes.
+
+        Args:
+            page_range (str): The range string, where ranges are specified as "start-end" and individual pages as numbers.
+
+        Returns:
+            list: A list of zero-based integer indexes.
+        """
+        indexes = []
+        # Split the input string by commas to handle multiple ranges/numbers
+        parts = page_range.split(",")
+
+        for part in parts:
+            # Check if the part specifies a range (e.g., "1-5")
+            if "-" in part:
+                start, end = map(int, part.split("-"))
+                indexes.extend(range(start - 1, end))  # Convert to zero-based indexes
+            else:
+                # Handle single page numbers
+                indexes.append(int(part) - 1)  # Convert to zero-based index
+
+        return sorted(indexes)  # Sort the final list
+
+    def update_model(self):
+        try:
+            self.enable_ui(False)
+
+            # Start Model Update in a separate thread
+            self.thread = UpdateModelThread(get_model_dir())
+
+            def on_finished(tag):
+                QMessageBox.information(
+                    self,
+                    "Model Update",
+                    f"The latest model ({tag}) has been downloaded successfully.",
+                    buttons=QMessageBox.Ok,
+                    defaultButton=QMessageBox.Ok,
+                )
+
+                self.enable_ui(True)
+
+            def on_error(msg):
+                QMessageBox.critical(
+                    self,
+                    "Error",
+                    f"An error occurred while updating the model:\n{msg}",
+                    buttons=QMessageBox.Ok,
+                    defaultButton=QMessageBox.Ok,
+                )
+
+                self.enable_ui(True)
+
+            self.thread.error.connect(on_error)
+            self.thread.finished.connect(on_finished)
+            self.thread.download_progress.connect(self.show_download_progress)
+            self.thread.start()
+
+        except Exception as e:
+            QMessageBox.critical(
+                self,
+                "Error",
+                f"An error occurred while updating the model:\n{str(e)}",
+                buttons=QMessageBox.Ok,
+                defaultButton=QMessageBox.Ok,
+            )
+
+            self.enable_ui(True)
+
+    def toggle_use_latest_model(self, state):
+        if not state:
+            self.widgetSelectMetadata.show()
+            self.widgetSelectModel.show()
+            self.adjustSize()
+        else:
+            self.widgetSelectMetadata.hide()
+            self.widgetSelectModel.hide()
+            self.adjustSize()
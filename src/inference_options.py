@@ -0,0 +1,31 @@
+EXECUTION_MODES = ["sequential", "parallel"]
+
+GRAPH_OPTIMIZATION_LEVELS = ["disable", "basic", "extended", "all"]
+
+
+class InferenceOptions:
+    def __init__(self):
+        # The number of contours to classify in a single call to the model.
+        # If 0, all contours on a page are classified together.
+        self.batch_size = 64
+
+        # If True, the int8 model next to the fp32 model is used if it exists.
+        # See scripts/convert_to_onnx.py.
+        self.quantized = False
+
+        # If True, each match keeps its test image and each page keeps its image
+        # with text removed after classification. This is useful for debugging,
+        # but uses a lot of memory on long documents.
+        self.keep_debug_images = False
+
+        # Options for the ONNX Runtime session. A thread count of 0 lets
+        # ONNX Runtime decide, which usually means one thread per core.
+        self.intra_op_num_threads = 0
+        self.inter_op_num_threads = 0
+        # One of EXECUTION_MODES
+        self.execution_mode = "sequential"
+        # One of GRAPH_OPTIMIZATION_LEVELS
+        self.graph_optimization_level = "all"
+        # If True, the optimized graph is saved next to the model file
+        # so that later runs load faster
+        self.cache_optimized_model = False
@@ -0,0 +1,146 @@
+"""
+Jobs
+
+This script contains the OCR jobs run by the server and by batch mode, and the
+pool of worker processes that runs them. Each worker loads the model once when
+it starts and keeps it for every job it runs.
+"""
+
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from model import load_onnx_model
+from model_metadata import load_metadata
+from ocr import process_image, process_pdf, write_analysis_to_stream
+
+
+class JobError(Exception):
+    """
+    Raised when a job cannot be run because of the way it was requested
+    """
+
+    pass
+
+
+class OCRJob:
+    def __init__(self):
+        self.input = None
+        # For PDFs, None means all pages
+        self.page_range = None
+        self.preprocess_options = None
+        self.inference_options = None
+        self.split_lr = False
+        self.output_format = "yaml"
+        # Where save_job writes the analysis
+        self.output = None
+        # The PageCache to use, if any
+        self.cache = None
+
+
+def run_job(job, model, metadata):
+    """
+    Runs an OCR job and returns the analysis serialized in the job's format
+    """
+    if job.input.endswith(".pdf"):
+        page_range = job.page_range
+
+        if page_range is None:
+            # pymupdf is slow to import, so it is only imported when needed
+            import pymupdf
+
+            with pymupdf.open(job.input) as doc:
+                page_range = range(len(doc))
+
+        analysis = process_pdf(
+            job.input,
+            page_range,
+            model,
+            metadata,
+            preprocess_options=job.preprocess_options,
+            split_lr=job.split_lr,
+            inference_options=job.inference_options,
+            cache=job.cache,
+        )
+    else:
+        image = cv2.imread(job.input, cv2.IMREAD_GRAYSCALE)
+
+        if image is None:
+            raise JobError(f"Could not read the image {job.input}.")
+
+        analysis = process_image(
+            image,
+            model,
+            metadata,
+            preprocess_options=job.preprocess_options,
+            split_lr=job.split_lr,
+            inference_options=job.inference_options,
+            cache=job.cache,
+        )
+
+    return write_analysis_to_stream(analysis, job.output_format)
+
+
+def save_job(job, model, metadata):
+    """
+    Runs an OCR job and writes the analysis to job.output
+    """
+    result = run_job(job, model, metadata)
+
+    if isinstance(result, str):
+        result = result.encode("utf-8")
+
+    # Write to a temporary file first, so that an interrupted job
+    # never leaves behind an output that looks complete
+    temp_path = f"{job.output}.{os.getpid()}.tmp"
+
+    try:
+        with open(temp_path, "wb") as outfile:
+            outfile.write(result)
+
+        os.replace(temp_path, job.output)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def create_job_executor(model_path, metadata_path, inference_options, workers=1):
+    """
+    Returns a ProcessPoolExecutor whose workers each load the model once.
+    Submit jobs to it with run_job_in_worker or save_job_in_worker.
+    """
+    # Split the cores between the workers so that
+    # their inference threads do not compete for them
+    worker_inference_options = copy.copy(inference_options)
+
+    if worker_inference_options.intra_op_num_threads == 0:
+        worker_inference_options.intra_op_num_threads = max(
+            1, (os.cpu_count() or 1) // workers
+        )
+
+    if worker_inference_options.inter_op_num_threads == 0:
+        worker_inference_options.inter_op_num_threads = 1
+
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_job_worker,
+        initargs=(model_path, metadata_path, worker_inference_options),
+    )
+
+
+_worker_state = {}
+
+
+def _init_job_worker(model_path, metadata_path, inference_options):
+    _worker_state["model"] = load_onnx_model(model_path, inference_options)
+    _worker_state["metadata"] = load_metadata(metadata_path)
+
+
+def run_job_in_worker(job):
+    return run_job(job, _worker_state["model"], _worker_state["metadata"])
+
+
+def save_job_in_worker(job):
+    save_job(job, _worker_state["model"], _worker_state["metadata"])
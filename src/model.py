@@ -1,17 +1,152 @@
+import os
+
 import numpy as np
 import onnxruntime as ort
 
+from inference_options import GRAPH_OPTIMIZATION_LEVELS, InferenceOptions
+
+MEAN = np.array([0.485, 0.456, 0.406])
+STD = np.array([0.229, 0.224, 0.225])
+
+# Per-channel scale and offset such that
+# (img / 255 - mean) / std == img * SCALE + OFFSET
+SCALE = (1 / (255.0 * STD)).astype(np.float32)
+OFFSET = (-MEAN / STD).astype(np.float32)
+
+# The highest level at which optimized graphs are cached. See load_onnx_model.
+CACHED_GRAPH_OPTIMIZATION_LEVEL = "extended"
+
+# The ONNX Runtime values of inference_options.GRAPH_OPTIMIZATION_LEVELS
+ORT_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# The ONNX Runtime values of inference_options.EXECUTION_MODES
+ORT_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def get_quantized_model_path(model_path):
+    """
+    Returns the path of the int8 model that scripts/convert_to_onnx.py
+    writes next to the given fp32 model, e.g. current_model.int8.onnx
+    """
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.int8{ext}"
+
+
+def get_optimized_model_path(model_path, graph_optimization_level):
+    """
+    Returns the path where the optimized graph of the given model is cached,
+    e.g. current_model.optimized-extended.onnx
+    """
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.optimized-{graph_optimization_level}{ext}"
+
+
+def create_session_options(inference_options):
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = inference_options.intra_op_num_threads
+    session_options.inter_op_num_threads = inference_options.inter_op_num_threads
+    session_options.execution_mode = ORT_EXECUTION_MODES[
+        inference_options.execution_mode
+    ]
+    session_options.graph_optimization_level = ORT_GRAPH_OPTIMIZATION_LEVELS[
+        inference_options.graph_optimization_level
+    ]
+
+    return session_options
+
+
+def load_onnx_model(model_path, inference_options=None):
+    """
+    Loads an ONNX model.
+
+    If inference_options.quantized is True and an int8 model exists
+    next to model_path, the int8 model is loaded instead.
+
+    If inference_options.cache_optimized_model is True, the optimized graph
+    is saved next to the model the first time it is loaded, and later loads
+    start from the saved graph instead of optimizing the model again.
+
+    The path of the loaded model file is stored in the session's model_path.
+    """
+    if inference_options is None:
+        inference_options = InferenceOptions()
+
+    if inference_options.quantized:
+        quantized_path = get_quantized_model_path(model_path)
+
+        if os.path.exists(quantized_path):
+            model_path = quantized_path
+        else:
+            print(f"No quantized model found at {quantized_path}. Using {model_path}.")
 
-def load_onnx_model(model_path):
-    return ort.InferenceSession(model_path)
+    session_options = create_session_options(inference_options)
+
+    if inference_options.cache_optimized_model:
+        session = load_optimized_model(model_path, session_options, inference_options)
+    else:
+        session = ort.InferenceSession(model_path, session_options)
+
+    # The file the model was loaded from, even if the session was loaded from
+    # the optimized graph. A PageCache uses it to identify the model.
+    session.model_path = model_path
+
+    return session
+
+
+def load_optimized_model(model_path, session_options, inference_options):
+    """
+    Loads a model from its cached optimized graph, optimizing
+    and saving the graph first if it is missing or out of date
+    """
+    # Graphs optimized at the "all" level may contain optimizations for the
+    # CPU they were made on, so the cache is saved at "extended" at most. The
+    # remaining optimizations run each time the cached graph is loaded.
+    saved_level = min(
+        inference_options.graph_optimization_level,
+        CACHED_GRAPH_OPTIMIZATION_LEVEL,
+        key=GRAPH_OPTIMIZATION_LEVELS.index,
+    )
+
+    optimized_path = get_optimized_model_path(model_path, saved_level)
+
+    if os.path.exists(optimized_path) and os.path.getmtime(
+        optimized_path
+    ) >= os.path.getmtime(model_path):
+        return ort.InferenceSession(optimized_path, session_options)
+
+    if not os.access(os.path.dirname(os.path.abspath(optimized_path)), os.W_OK):
+        return ort.InferenceSession(model_path, session_options)
+
+    save_options = create_session_options(inference_options)
+    save_options.graph_optimization_level = ORT_GRAPH_OPTIMIZATION_LEVELS[saved_level]
+
+    # Several processes may load the model at the same time, so
+    # each one writes its own file and then atomically replaces the cache
+    temp_path = f"{optimized_path}.{os.getpid()}.tmp"
+    save_options.optimized_model_filepath = temp_path
+
+    try:
+        ort.InferenceSession(model_path, save_options)
+        os.replace(temp_path, optimized_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return ort.InferenceSession(optimized_path, session_options)
 
 
 def transform(img):
     transformed = img.copy()
     transformed = transformed / 255.0  # Normalize to [0, 1]
-    transformed = (transformed - np.array([0.485, 0.456, 0.406])) / np.array(
-        [0.229, 0.224, 0.225]
-    )  # Apply mean/std
+    transformed = (transformed - MEAN) / STD  # Apply mean/std
 
     # Rearrange the dimensions to (channels, height, width)
     transformed = np.transpose(transformed, (2, 0, 1))  # Convert HWC to CHW
@@ -20,3 +155,34 @@ def transform(img):
     transformed = np.expand_dims(transformed, axis=0)
 
     return transformed
+
+
+def transform_batch(images, out=None):
+    """
+    Normalizes a stack of grayscale images for the model.
+
+    Parameters
+    ----------
+    images: ndarray
+        An (N, height, width) uint8 array of grayscale images.
+
+    out: ndarray, optional
+        A preallocated (N, 3, height, width) float32 buffer to write into.
+
+    Returns
+    -------
+    ndarray
+        The normalized (N, 3, height, width) float32 tensor
+    """
+    n, h, w = images.shape
+
+    if out is None:
+        out = np.empty((n, 3, h, w), dtype=np.float32)
+
+    # The images are grayscale, so each channel is the same image
+    # normalized with that channel's mean and std
+    for c in range(3):
+        np.multiply(images, SCALE[c], out=out[:, c])
+        out[:, c] += OFFSET[c]
+
+    return out
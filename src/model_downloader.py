@@ -1,46 +1,481 @@
+"""
+Model downloader
+
+This script downloads released models into a local store under the model
+directory. Each release is kept in its own folder, keyed by its tag and the
+hash of its model file:
+
+    models/
+        store/
+            model_v0.0.4-0123456789ab/
+                current_model.onnx
+                metadata.json
+                manifest.json
+        current.json
+
+manifest.json records the tag and the SHA-256 checksum of each file.
+current.json records which stored model is in use.
+
+Older versions downloaded the model straight into models/latest/. If there is
+no current.json, a model found there is copied into the store under the tag
+"legacy", so that upgrading does not require a connection.
+
+Files are downloaded in chunks into store/.download-<tag>/. If a download is
+interrupted, it is retried with backoff and resumed from where it stopped with
+an HTTP Range request. The partial files are kept if every retry fails, so that
+the next download of the same release resumes them too.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import time
 from pathlib import Path
 
 import requests
 
+LATEST_JSON_URL = "https://raw.githubusercontent.com/neanes/byzantine-chant-ocr/master/dist/model/latest.json"
+
+MODEL_FILENAME = "current_model.onnx"
+METADATA_FILENAME = "metadata.json"
+MANIFEST_FILENAME = "manifest.json"
+
+# The folder older versions downloaded the model into, and the
+# tag the model is stored under when it is imported
+LEGACY_DIRNAME = "latest"
+LEGACY_TAG = "legacy"
+
+# The files of a release, keyed by their names in latest.json
+ASSET_FILENAMES = {"model": MODEL_FILENAME, "metadata": METADATA_FILENAME}
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT_SECONDS = 30
+
+# Downloads are written in smaller chunks, since a chunk
+# that is cut off by a dropped connection is lost
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The number of times a download is retried after a network error,
+# and the delay before the first retry, which doubles after each retry
+RETRIES = 5
+BACKOFF_SECONDS = 1.0
+
+# Server errors that are worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ChecksumError(Exception):
+    """
+    Raised when a downloaded file does not match its expected checksum
+    """
+
+    pass
 
-def download_latest_model(out_dir: Path):
+
+class StoredModel:
+    def __init__(self, path: Path, tag: str, checksums: dict):
+        self.path = path
+        self.tag = tag
+        # The SHA-256 checksum of each file, keyed like ASSET_FILENAMES
+        self.checksums = checksums
+
+    @property
+    def model_path(self) -> Path:
+        return self.path / MODEL_FILENAME
+
+    @property
+    def metadata_path(self) -> Path:
+        return self.path / METADATA_FILENAME
+
+
+def download_latest_model(
+    model_dir: Path, latest_json_url=LATEST_JSON_URL, progress=None
+):
     """
-    Downloads the latest model assets based on dist/model/latest.json in the repo.
-    Saves current_model.onnx and metadata.json into out_dir.
+    Makes the latest released model the current model, based on
+    dist/model/latest.json in the repo. The model is only downloaded if it
+    is not already in the store.
+
+    Args:
+        progress (function): Called as progress(filename, downloaded, total)
+            while each file is downloaded. total is None if the server does not
+            report the size of the file.
 
     Returns:
         str: The tag of the latest release.
     """
-    out_dir.mkdir(parents=True, exist_ok=True)
+    response = requests.get(latest_json_url, timeout=TIMEOUT_SECONDS)
+    response.raise_for_status()
+    latest_info = response.json()
 
-    owner = "neanes"
-    repo = "byzantine-chant-ocr"
-    branch = "master"
+    tag = latest_info["latest_release"]
+    # Older versions of latest.json do not list checksums
+    checksums = latest_info.get("checksums", {})
 
-    # URL of the JSON file in the repo
-    latest_json_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/dist/model/latest.json"
+    stored_model = find_stored_model(model_dir, tag, checksums.get("model"))
 
-    # Fetch latest.json
-    response = requests.get(latest_json_url)
-    response.raise_for_status()
-    latest_info = response.json()
+    if stored_model is None:
+        stored_model = download_model(
+            model_dir, tag, latest_info["assets"], checksums, progress
+        )
+
+    set_current_model(model_dir, stored_model)
+
+    return tag
+
+
+def get_current_model(model_dir: Path):
+    """
+    Returns the StoredModel in use, or None if no model has been downloaded
+    """
+    try:
+        with open(model_dir / "current.json") as f:
+            current = json.load(f)
+
+        return load_stored_model(model_dir / "store" / current["path"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def ensure_current_model(
+    model_dir: Path, latest_json_url=LATEST_JSON_URL, progress=None
+):
+    """
+    Returns the StoredModel in use, downloading the latest model first
+    if no model has been downloaded or the model's files are damaged.
+    See download_latest_model for progress.
+    """
+    stored_model = get_current_model(model_dir)
+
+    if stored_model is None and not (model_dir / "current.json").exists():
+        stored_model = import_legacy_model(model_dir)
+
+        if stored_model is not None:
+            set_current_model(model_dir, stored_model)
+
+    if stored_model is None or not verify_stored_model(stored_model):
+        download_latest_model(model_dir, latest_json_url, progress)
+        stored_model = get_current_model(model_dir)
+
+    return stored_model
+
+
+def set_current_model(model_dir: Path, stored_model: StoredModel):
+    write_json_atomically(model_dir / "current.json", {"path": stored_model.path.name})
+
+
+def find_stored_model(model_dir: Path, tag: str, model_checksum=None):
+    """
+    Returns the StoredModel of the given release if it is in the store and
+    its files are intact, otherwise None
+    """
+    store_dir = model_dir / "store"
+
+    if not store_dir.is_dir():
+        return None
+
+    for path in sorted(store_dir.glob(f"{get_safe_tag(tag)}-*")):
+        try:
+            stored_model = load_stored_model(path)
+        except (OSError, ValueError, KeyError):
+            continue
+
+        if stored_model.tag != tag:
+            continue
+
+        if model_checksum and stored_model.checksums["model"] != model_checksum:
+            continue
+
+        if verify_stored_model(stored_model):
+            return stored_model
+
+    return None
+
+
+def load_stored_model(path: Path):
+    with open(path / MANIFEST_FILENAME) as f:
+        manifest = json.load(f)
+
+    return StoredModel(path, manifest["tag"], manifest["checksums"])
+
+
+def verify_stored_model(stored_model: StoredModel):
+    """
+    Returns True if the files of a stored model match its manifest
+    """
+    for name, filename in ASSET_FILENAMES.items():
+        path = stored_model.path / filename
+
+        if not path.is_file() or file_sha256(path) != stored_model.checksums[name]:
+            return False
+
+    return True
+
+
+def import_legacy_model(model_dir: Path):
+    """
+    Copies the model that older versions downloaded into model_dir/latest/
+    into the store, and returns its StoredModel. Returns None if there is no
+    such model or its files are unusable. The files in latest/ are left in
+    place for older versions.
+    """
+    legacy_dir = model_dir / LEGACY_DIRNAME
+
+    try:
+        if (legacy_dir / MODEL_FILENAME).stat().st_size == 0:
+            return None
+
+        with open(legacy_dir / METADATA_FILENAME) as f:
+            json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    checksums = {
+        name: file_sha256(legacy_dir / filename)
+        for name, filename in ASSET_FILENAMES.items()
+    }
+
+    stored_model = find_stored_model(model_dir, LEGACY_TAG, checksums["model"])
+
+    if stored_model is not None:
+        return stored_model
+
+    store_dir = model_dir / "store"
+    temp_dir = store_dir / f".import-{LEGACY_TAG}"
+
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+
+    temp_dir.mkdir(parents=True)
+
+    for filename in ASSET_FILENAMES.values():
+        shutil.copyfile(legacy_dir / filename, temp_dir / filename)
+
+    with open(temp_dir / MANIFEST_FILENAME, "w") as f:
+        json.dump({"tag": LEGACY_TAG, "checksums": checksums}, f, indent=2)
+
+    path = store_dir / f"{LEGACY_TAG}-{checksums['model'][:12]}"
+
+    if path.exists():
+        shutil.rmtree(path)
+
+    os.replace(temp_dir, path)
+
+    stored_model = StoredModel(path, LEGACY_TAG, checksums)
+
+    # The files may have changed while they were copied
+    if not verify_stored_model(stored_model):
+        shutil.rmtree(path)
+        return None
+
+    return stored_model
+
+
+def download_model(
+    model_dir: Path, tag: str, assets: dict, checksums: dict, progress=None
+):
+    """
+    Downloads the files of a release into the store. The files are downloaded
+    into a temporary folder, which is renamed once every file is complete and
+    verified, so that the store never contains a partial release.
+    """
+    store_dir = model_dir / "store"
+    temp_dir = store_dir / f".download-{get_safe_tag(tag)}"
+    temp_dir.mkdir(parents=True, exist_ok=True)
+
+    actual_checksums = {}
+
+    for name, filename in ASSET_FILENAMES.items():
+        file_progress = None
+
+        if progress is not None:
+            file_progress = functools.partial(progress, filename)
+
+        actual_checksums[name] = download_file(
+            assets[name], temp_dir / filename, file_progress
+        )
+
+        expected = checksums.get(name)
+
+        if expected and actual_checksums[name] != expected:
+            # Start over next time, since the partial
+            # files cannot be trusted either
+            shutil.rmtree(temp_dir)
+
+            raise ChecksumError(
+                f"The checksum of {assets[name]} is {actual_checksums[name]}, expected {expected}."
+            )
+
+    with open(temp_dir / MANIFEST_FILENAME, "w") as f:
+        json.dump({"tag": tag, "checksums": actual_checksums}, f, indent=2)
+
+    path = store_dir / f"{get_safe_tag(tag)}-{actual_checksums['model'][:12]}"
+
+    # A damaged copy of the same release may already be in the store
+    if path.exists():
+        shutil.rmtree(path)
+
+    os.replace(temp_dir, path)
+
+    return StoredModel(path, tag, actual_checksums)
+
+
+def download_file(
+    url: str, path: Path, progress=None, retries=RETRIES, backoff=BACKOFF_SECONDS
+):
+    """
+    Streams a file to disk in chunks and returns its SHA-256 checksum.
+
+    If the file already exists, it is treated as a partial download and
+    resumed with an HTTP Range request. Network errors and server errors are
+    retried with exponential backoff. A retry that receives part of the file
+    resets the count, so a slow, unreliable connection still finishes.
+
+    Args:
+        progress (function): Called as progress(downloaded, total) after each
+            chunk. total is None if the server does not report it.
+    """
+    failures = 0
+
+    while True:
+        offset = path.stat().st_size if path.exists() else 0
+
+        try:
+            return _download_file_from(url, path, offset, progress)
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            error = e
+        except requests.HTTPError as e:
+            if e.response.status_code not in RETRY_STATUS_CODES:
+                raise
+
+            error = e
+
+        if path.exists() and path.stat().st_size > offset:
+            failures = 0
+        else:
+            failures += 1
+
+        if failures > retries:
+            raise error
+
+        time.sleep(backoff * 2 ** max(0, failures - 1))
+
+
+def _download_file_from(url: str, path: Path, offset: int, progress):
+    # Ask for the file as it is stored, so that byte offsets match the file
+    headers = {"Accept-Encoding": "identity"}
+
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+
+    with requests.get(
+        url, headers=headers, stream=True, timeout=TIMEOUT_SECONDS
+    ) as response:
+        if response.status_code == 416:
+            # The partial file is already complete, or is
+            # longer than the file on the server
+            if get_content_range_total(response) == offset:
+                if progress is not None:
+                    progress(offset, offset)
+
+                return file_sha256(path)
+
+            path.unlink()
+            return _download_file_from(url, path, 0, progress)
+
+        response.raise_for_status()
+
+        total = None
+
+        if response.status_code == 206:
+            if not response.headers.get("Content-Range", "").startswith(
+                f"bytes {offset}-"
+            ):
+                path.unlink()
+                return _download_file_from(url, path, 0, progress)
+
+            total = get_content_range_total(response)
+        else:
+            # The server ignored the Range header and sent the whole file
+            offset = 0
+
+            if "Content-Length" in response.headers:
+                total = int(response.headers["Content-Length"])
+
+        sha256 = hashlib.sha256()
+
+        # Include the partial file in the checksum
+        if offset > 0:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+
+        downloaded = offset
+
+        with open(path, "ab" if offset > 0 else "wb") as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                sha256.update(chunk)
+                downloaded += len(chunk)
+
+                if progress is not None:
+                    progress(downloaded, total)
+
+        # A connection that is closed early without an error
+        # still leaves the file incomplete
+        if total is not None and downloaded < total:
+            raise requests.ConnectionError(
+                f"The download of {url} stopped at {downloaded} of {total} bytes."
+            )
+
+    return sha256.hexdigest()
+
+
+def get_content_range_total(response):
+    """
+    Returns the total size from a Content-Range header such as
+    "bytes 100-199/200" or "bytes */200", or None if it is unknown
+    """
+    try:
+        return int(response.headers["Content-Range"].rsplit("/", 1)[1])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def file_sha256(path: Path):
+    sha256 = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def get_safe_tag(tag: str):
+    """
+    Returns the tag in a form that can be used as a folder name,
+    e.g. model/v0.0.4 becomes model_v0.0.4
+    """
+    return "".join(c if c.isalnum() or c in ".-" else "_" for c in tag)
 
-    # Extract URLs for model assets
-    model_url = latest_info["assets"]["model"]
-    metadata_url = latest_info["assets"]["metadata"]
 
-    # Prepare paths
-    model_out = out_dir / "current_model.onnx"
-    metadata_out = out_dir / "metadata.json"
+def write_json_atomically(path: Path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Download model file
-    r = requests.get(model_url)
-    r.raise_for_status()
-    model_out.write_bytes(r.content)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
 
-    # Download metadata
-    r = requests.get(metadata_url)
-    r.raise_for_status()
-    metadata_out.write_bytes(r.content)
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=2)
 
-    return latest_info["latest_release"]
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
@@ -1,41 +1,148 @@
+import copy
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
+import msgpack
 import numpy as np
-import pymupdf
 import yaml
 
 import util
-from analysis_models import Analysis, Circle, ContourMatch, PageAnalysis, Rect
+from analysis_models import (
+    Analysis,
+    Circle,
+    ContourMatch,
+    MatchTable,
+    PageAnalysis,
+    Rect,
+)
+from inference_options import InferenceOptions
 from interpretation import interpret_page_analysis
 from interpretation_options import InterpretationOptions
-from model import transform
+from model import load_onnx_model, transform_batch
+from pipeline import run_pipeline
+from preprocess_options import PreprocessOptions
 from segmentation import segment
 from text_removal import remove_text
 
+# Use the much faster libyaml emitter if it is available
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
+def save_analysis(analysis, filepath="output.yaml", output_format="yaml"):
+    mode = "wb" if output_format == "msgpack" else "w"
+
+    with open(filepath, mode) as outfile:
+        dump_analysis(analysis, outfile, output_format)
+
+
+def write_analysis_to_stream(analysis, output_format="yaml"):
+    stream = io.BytesIO() if output_format == "msgpack" else io.StringIO()
 
-class PreprocessOptions:
-    def __init__(self):
-        self.deskew = True
-        self.deskew_max_angle = 5
-        self.deskew_initial_delta = 1
-        self.despeckle = True
-        self.despeckle_kernel_size = 3
-        self.close = True
-        self.close_kernel_size = 2
+    dump_analysis(analysis, stream, output_format)
 
+    return stream.getvalue()
 
-def save_analysis(analysis, filepath="output.yaml"):
-    with open(filepath, "w") as outfile:
-        yaml.safe_dump(
-            analysis.to_dict(), outfile, sort_keys=False, default_flow_style=False
+
+def dump_analysis(analysis, stream, output_format="yaml"):
+    """
+    Writes an analysis to a stream in one of the OUTPUT_FORMATS.
+    The stream must be binary for msgpack and text otherwise.
+    """
+    data = analysis.to_dict()
+
+    if output_format == "yaml":
+        yaml.dump(
+            data,
+            stream,
+            Dumper=SafeDumper,
+            sort_keys=False,
+            default_flow_style=False,
+        )
+    elif output_format == "json":
+        json.dump(data, stream, ensure_ascii=False, separators=(",", ":"))
+    elif output_format == "msgpack":
+        msgpack.pack(data, stream)
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+
+class AnalysisWriter:
+    """
+    Writes an analysis to a stream one page at a time, so that pages do not
+    need to be kept in memory until the end of the run. The output is identical
+    to `save_analysis`.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.additional_metadata = {}
+        self.page_count = 0
+
+    def write_header(self, analysis):
+        header = analysis.header_to_dict()
+        header["additional_metadata"] = {
+            **analysis.additional_metadata,
+            **self.additional_metadata,
+        }
+
+        yaml.dump(
+            header,
+            self.stream,
+            Dumper=SafeDumper,
+            sort_keys=False,
+            default_flow_style=False,
         )
 
+    def write_page(self, page):
+        if self.page_count == 0:
+            self.stream.write("pages:\n")
 
-def write_analysis_to_stream(analysis):
-    stream = yaml.safe_dump(
-        analysis.to_dict(), sort_keys=False, default_flow_style=False
-    )
+        yaml.dump(
+            [page.to_dict()],
+            self.stream,
+            Dumper=SafeDumper,
+            sort_keys=False,
+            default_flow_style=False,
+        )
+        self.stream.flush()
+
+        self.page_count = self.page_count + 1
+
+    def close(self):
+        if self.page_count == 0:
+            self.stream.write("pages: []\n")
+
+        self.stream.flush()
+
+
+def add_page(analysis, page, writer=None):
+    """
+    Adds a page to the analysis. If a writer is given, the page is written
+    immediately and its images are released instead.
+    """
+    if writer is None:
+        analysis.pages.append(page)
+        return
+
+    writer.write_page(page)
+    release_page_images(page)
+
+
+def release_page_images(page):
+    page.image_with_text_removed = None
+
+    # A MatchTable does not hold test images
+    if isinstance(page.matches, MatchTable):
+        return
 
-    return stream
+    for m in page.matches:
+        m.test_image = None
 
 
 def process_pdf(
@@ -45,102 +152,481 @@ def process_pdf(
     metadata,
     preprocess_options=PreprocessOptions(),
     split_lr=False,
+    inference_options=InferenceOptions(),
+    writer=None,
+    cache=None,
 ):
+    """
+    Performs OCR on a range of pages in a PDF. Rendering, preprocessing and
+    recognition run as a pipeline, so that the stages of consecutive pages overlap.
+
+    If an `AnalysisWriter` is given, each page is written as soon as it is
+    finished and is not kept in the returned analysis.
+
+    If a `PageCache` is given, the stages of pages that were processed before
+    with the same options and model are loaded from it instead of rerun.
+    """
+    # pymupdf is slow to import, so it is only imported when needed
+    import pymupdf
+
     interpretation_options = InterpretationOptions()
 
     analysis = Analysis()
     analysis.model_metadata = metadata
 
+    if writer is not None:
+        writer.write_header(analysis)
+
     doc = pymupdf.open(filepath)
 
-    page_index = 0
+    page_nums = []
 
     for page_num in page_range:
         if page_num < 0 or page_num >= len(doc):
             print(f"Page {page_num} is out of range. Skipping.")
             continue
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(dpi=300)  # High DPI for quality
 
-        # convert to numpy format so opencv can understand it
-        image = np.frombuffer(pix.samples, dtype=np.uint8)
-        image = image.reshape((pix.height, pix.width, pix.n))
+        page_nums.append(page_num)
+
+    def render_stage(page_num):
+        image, bitonal = load_pdf_page_image(
+            doc, page_num, preprocess_options, split_lr
+        )
+        yield page_num, image, bitonal
+
+    def prepare_stage(item):
+        page_num, image, bitonal = item
+        yield from prepare_pdf_page(
+            image, page_num, preprocess_options, split_lr, bitonal, cache
+        )
+
+    def recognize_stage(page):
+        recognize_page(
+            page, model, metadata, inference_options, interpretation_options, cache
+        )
+        yield page
+
+    pages = run_pipeline(page_nums, [render_stage, prepare_stage, recognize_stage])
+
+    for page_index, page in enumerate(pages):
+        page.id = page_index
+
+        add_page(analysis, page, writer)
+
+    return analysis
+
+
+def process_pdf_parallel(
+    filepath,
+    page_range,
+    model_path,
+    metadata,
+    preprocess_options=PreprocessOptions(),
+    split_lr=False,
+    inference_options=InferenceOptions(),
+    workers=None,
+    writer=None,
+    cache=None,
+):
+    """
+    Same as `process_pdf`, but processes the pages in a pool of worker processes.
+    Each worker opens its own copy of the document and loads its own model.
+    """
+    import pymupdf
+
+    analysis = Analysis()
+    analysis.model_metadata = metadata
+
+    if writer is not None:
+        writer.write_header(analysis)
 
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    with pymupdf.open(filepath) as doc:
+        page_count = len(doc)
 
-        inner_pages = [image]
-        page_areas = []
+    page_nums = []
 
-        if split_lr:
-            width = image.shape[1]
-            left = image[:, : width // 2]
-            right = image[:, width // 2 :]
-            inner_pages = [left, right]
-            page_areas = ["left", "right"]
+    for page_num in page_range:
+        if page_num < 0 or page_num >= page_count:
+            print(f"Page {page_num} is out of range. Skipping.")
+            continue
 
-        for i, img in enumerate(inner_pages):
-            page = prepare_image(img, preprocess_options)
-            page.id = page_index
-            page.original_page_num = page_num + 1
+        page_nums.append(page_num)
 
-            if len(page_areas) > 0:
-                page.page_area = page_areas[i]
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-            page_index = page_index + 1
+    # Unless told otherwise, split the cores between the workers
+    # so that their inference threads do not compete for them
+    worker_inference_options = copy.copy(inference_options)
 
-            recognize_contours(page.matches, model, metadata.classes)
+    if worker_inference_options.intra_op_num_threads == 0:
+        worker_inference_options.intra_op_num_threads = max(
+            1, (os.cpu_count() or 1) // workers
+        )
+
+    if worker_inference_options.inter_op_num_threads == 0:
+        worker_inference_options.inter_op_num_threads = 1
 
-            interpret_page_analysis(page, interpretation_options)
+    page_index = 0
 
-            analysis.pages.append(page)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_pdf_worker,
+        initargs=(
+            filepath,
+            model_path,
+            metadata,
+            preprocess_options,
+            split_lr,
+            worker_inference_options,
+            cache,
+        ),
+    ) as executor:
+        # map() yields the results in page order
+        for pages in executor.map(_process_pdf_page_in_worker, page_nums):
+            for page in pages:
+                page.id = page_index
+                page_index = page_index + 1
+
+                add_page(analysis, page, writer)
 
     return analysis
 
 
-def process_image(
-    image, model, metadata, preprocess_options=PreprocessOptions(), split_lr=False
+_worker_state = {}
+
+
+def _init_pdf_worker(
+    filepath,
+    model_path,
+    metadata,
+    preprocess_options,
+    split_lr,
+    inference_options,
+    cache,
 ):
-    interpretation_options = InterpretationOptions()
+    import pymupdf
+
+    _worker_state["doc"] = pymupdf.open(filepath)
+    _worker_state["model"] = load_onnx_model(model_path, inference_options)
+    _worker_state["metadata"] = metadata
+    _worker_state["preprocess_options"] = preprocess_options
+    _worker_state["split_lr"] = split_lr
+    _worker_state["inference_options"] = inference_options
+    _worker_state["interpretation_options"] = InterpretationOptions()
+    _worker_state["cache"] = cache
+
+
+def _process_pdf_page_in_worker(page_num):
+    return process_pdf_page(
+        _worker_state["doc"],
+        page_num,
+        _worker_state["model"],
+        _worker_state["metadata"],
+        _worker_state["preprocess_options"],
+        _worker_state["split_lr"],
+        _worker_state["inference_options"],
+        _worker_state["interpretation_options"],
+        _worker_state["cache"],
+    )
 
-    analysis = Analysis()
-    analysis.model_metadata = metadata
 
-    inner_pages = [image]
-    page_areas = []
+def process_pdf_page(
+    doc,
+    page_num,
+    model,
+    metadata,
+    preprocess_options,
+    split_lr,
+    inference_options,
+    interpretation_options,
+    cache=None,
+):
+    """
+    Performs OCR on a single page of an open PDF document.
+    Returns one PageAnalysis per inner page. The page ids are not assigned.
+    """
+    image, bitonal = load_pdf_page_image(doc, page_num, preprocess_options, split_lr)
+
+    pages = prepare_pdf_page(
+        image, page_num, preprocess_options, split_lr, bitonal, cache
+    )
+
+    for page in pages:
+        recognize_page(
+            page, model, metadata, inference_options, interpretation_options, cache
+        )
+
+    return pages
+
+
+def prepare_pdf_page(
+    image, page_num, preprocess_options, split_lr, bitonal=False, cache=None
+):
+    pages = []
+
+    for img, page_area in split_page(image, split_lr):
+        page = prepare_image(img, preprocess_options, bitonal, cache)
+        page.original_page_num = page_num + 1
+        page.page_area = page_area
+
+        pages.append(page)
+
+    return pages
+
+
+def recognize_page(
+    page, model, metadata, inference_options, interpretation_options, cache=None
+):
+    recognition = None
+
+    if cache is not None and page.cache_key is not None:
+        model_key = cache.get_model_key(model.model_path, metadata)
+        recognition = cache.load_recognition(page.cache_key, model_key)
+
+    # A recognition saved for a different number of matches is stale
+    if recognition is not None and any(
+        len(values) != len(page.matches) for values in recognition
+    ):
+        recognition = None
+
+    if recognition is not None:
+        for m, label, confidence in zip(page.matches, *recognition):
+            m.label = label
+            m.confidence = confidence
+    else:
+        recognize_contours(
+            page.matches,
+            model,
+            metadata.classes,
+            batch_size=inference_options.batch_size,
+        )
+
+        if cache is not None and page.cache_key is not None:
+            cache.save_recognition(page.cache_key, model_key, page.matches)
+
+    if not inference_options.keep_debug_images:
+        # The test images are no longer needed once the matches are classified,
+        # so store the matches compactly for the rest of the page's lifetime.
+        # This also frees the page's test image arena.
+        page.matches = MatchTable.from_matches(page.matches)
+        page.image_with_text_removed = None
+
+    interpret_page_analysis(page, interpretation_options)
+
+
+def load_pdf_page_image(doc, page_num, preprocess_options, split_lr):
+    """
+    Returns the grayscale image of a PDF page, and whether the image is
+    bitonal, i.e. only contains the values 0 and 255.
+
+    If preprocess_options.pdf_extract_images is True, the image of a scanned
+    page is taken directly from the PDF. Other pages are rendered.
+    """
+    if preprocess_options.pdf_extract_images:
+        extracted = extract_pdf_page_image(
+            doc, page_num, preprocess_options.pdf_dpi, split_lr
+        )
 
+        if extracted is not None:
+            return extracted
+
+    return render_pdf_page(doc, page_num, preprocess_options.pdf_dpi, split_lr), False
+
+
+def extract_pdf_page_image(doc, page_num, max_dpi=300, split_lr=False):
+    """
+    Returns the embedded image of a page that consists of a single upright
+    image covering the whole page, as a (image, bitonal) tuple. The image is
+    the same size that render_pdf_page would produce. Returns None for any
+    other page, or if the embedded image has a lower resolution than that.
+    """
+    import pymupdf
+
+    page = doc.load_page(page_num)
+
+    if page.rotation != 0 or page.first_annot is not None:
+        return None
+
+    # get_image_info(xrefs=True) would hash every image,
+    # so find the xref of the image in the page's resources
+    images = page.get_image_info()
+    xrefs = page.get_images(full=True)
+
+    if len(images) != 1 or len(xrefs) != 1:
+        return None
+
+    info = images[0]
+    xref, smask, width, height = xrefs[0][:4]
+
+    # The image that is drawn may be an inline image. Image masks
+    # and images with transparency depend on what is under them.
+    if (width, height) != (info["width"], info["height"]):
+        return None
+
+    if smask != 0 or info["has-mask"] or info["colorspace"] == 0:
+        return None
+
+    a, b, c, d, _, _ = info["transform"]
+
+    if b != 0 or c != 0 or a <= 0 or d <= 0:
+        return None
+
+    if any(abs(x - y) > 1 for x, y in zip(info["bbox"], page.rect)):
+        return None
+
+    # Vector drawings and visible text would be lost. Invisible text,
+    # such as the text layer of a scan that has been OCRed, is ignored.
+    if page.get_cdrawings():
+        return None
+
+    for span in page.get_texttrace():
+        if span["type"] != 3 and span["opacity"] > 0:
+            return None
+
+    zoom = get_pdf_page_zoom(page.rect.width, page.rect.height, max_dpi, split_lr)
+    size = (page.rect * pymupdf.Matrix(zoom, zoom)).irect
+
+    if info["width"] < size.width or info["height"] < size.height:
+        return None
+
+    pix = pymupdf.Pixmap(doc, xref)
+
+    if pix.alpha:
+        pix = pymupdf.Pixmap(pix, 0)
+
+    if pix.n != 1:
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, pix)
+
+    image = np.asarray(PixmapSamples(pix))
+
+    # A 1-bit grayscale image decodes to 0 and 255
+    bitonal = info["bpc"] == 1 and info["colorspace"] == 1
+
+    if image.shape != (size.height, size.width):
+        image = cv2.resize(
+            image, (size.width, size.height), interpolation=cv2.INTER_AREA
+        )
+        bitonal = False
+
+    return image, bitonal
+
+
+def render_pdf_page(doc, page_num, max_dpi=300, split_lr=False):
+    """
+    Renders a PDF page as a grayscale image. The page is rendered at
+    max_dpi, or at the DPI at which it fits the downsize target if that is
+    lower, so that it does not need to be downsized afterwards.
+    """
+    import pymupdf
+
+    page = doc.load_page(page_num)
+
+    zoom = get_pdf_page_zoom(page.rect.width, page.rect.height, max_dpi, split_lr)
+
+    pix = page.get_pixmap(
+        matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csGRAY, alpha=False
+    )
+
+    # Wrap the pixmap's samples without copying them
+    return np.asarray(PixmapSamples(pix))
+
+
+def get_pdf_page_zoom(width, height, max_dpi, split_lr):
+    """
+    Returns the scale from PDF points (1/72 inch) to pixels at which a page
+    is rendered. If split_lr is True, the target applies to each half.
+    """
+    max_width = util.DOWNSIZE_MAX_WIDTH * (2 if split_lr else 1)
+    max_height = util.DOWNSIZE_MAX_HEIGHT
+
+    return min(max_dpi / 72, max_width / width, max_height / height)
+
+
+class PixmapSamples:
+    """
+    Exposes the samples of a single-channel pixmap to NumPy. Arrays created
+    from it keep it, and therefore the pixmap, alive.
+    """
+
+    def __init__(self, pix):
+        self.pix = pix
+        self.__array_interface__ = {
+            "shape": (pix.height, pix.width),
+            "strides": (pix.stride, 1),
+            "typestr": "|u1",
+            "data": (pix.samples_ptr, True),
+            "version": 3,
+        }
+
+
+def split_page(image, split_lr):
+    """
+    Returns a list of (image, page_area) tuples. If split_lr is True,
+    the image is split into its left and right halves.
+    """
     if split_lr:
         width = image.shape[1]
         left = image[:, : width // 2]
         right = image[:, width // 2 :]
-        inner_pages = [left, right]
-        page_areas = ["left", "right"]
+        return [(left, "left"), (right, "right")]
 
-    for i, img in enumerate(inner_pages):
-        page = prepare_image(img, preprocess_options)
-        page.id = i
+    return [(image, None)]
 
-        if len(page_areas) > 0:
-            page.page_area = page_areas[i]
 
-        recognize_contours(page.matches, model, metadata.classes)
-        interpret_page_analysis(page, interpretation_options)
+def process_image(
+    image,
+    model,
+    metadata,
+    preprocess_options=PreprocessOptions(),
+    split_lr=False,
+    inference_options=InferenceOptions(),
+    cache=None,
+):
+    interpretation_options = InterpretationOptions()
+
+    analysis = Analysis()
+    analysis.model_metadata = metadata
+
+    for i, (img, page_area) in enumerate(split_page(image, split_lr)):
+        page = prepare_image(img, preprocess_options, cache=cache)
+        page.id = i
+        page.page_area = page_area
+
+        recognize_page(
+            page, model, metadata, inference_options, interpretation_options, cache
+        )
 
         analysis.pages.append(page)
 
     return analysis
 
 
-def preprocess_image(image, preprocess_options=PreprocessOptions()):
+def preprocess_image(image, preprocess_options=PreprocessOptions(), bitonal=False):
+    """
+    Returns the binary image of a page. If the image is bitonal, i.e. only
+    contains the values 0 and 255, it does not need to be thresholded unless
+    it is resized or deskewed.
+    """
     resized = util.downsize(image)
 
     if preprocess_options.deskew:
-        angle, resized = util.deskew(
+        deskew = (
+            util.deskew_fast
+            if preprocess_options.deskew_strategy == "fast"
+            else util.deskew
+        )
+
+        angle, resized = deskew(
             resized,
             limit=preprocess_options.deskew_max_angle,
             delta=preprocess_options.deskew_initial_delta,
         )
 
-    binary = util.to_binary(resized)
+    if bitonal and resized is image:
+        binary = cv2.bitwise_not(resized)
+    else:
+        binary = util.to_binary(resized)
 
     if preprocess_options.despeckle:
         binary = cv2.medianBlur(binary, preprocess_options.despeckle_kernel_size)
@@ -158,13 +644,50 @@ def preprocess_image(image, preprocess_options=PreprocessOptions()):
     return binary
 
 
-def prepare_image(image, preprocess_options):
+def prepare_image(image, preprocess_options, bitonal=False, cache=None):
+    """
+    Preprocesses and segments a page, removes the text and cuts out the
+    matches to recognize. If a PageCache is given, each stage whose result
+    is in the cache is loaded instead of computed.
+    """
     page = PageAnalysis()
 
-    binary = preprocess_image(image, preprocess_options)
+    segmentation = None
+    text_removed = None
+
+    if cache is not None:
+        page.cache_key = cache.get_key(image, preprocess_options)
+        segmentation = cache.load_segmentation(page.cache_key)
+        text_removed = cache.load_image(page.cache_key, "text_removed")
+
+    if segmentation is None or text_removed is None:
+        binary = None
+
+        if cache is not None:
+            binary = cache.load_image(page.cache_key, "binary")
+
+        if binary is None:
+            binary = preprocess_image(image, preprocess_options, bitonal)
+
+            if cache is not None:
+                cache.save_image(page.cache_key, "binary", binary)
+
+        # Segmentation and text removal share the contours of the binary image
+        contour_index = util.ContourIndex(binary)
+
+        if segmentation is None:
+            segmentation = segment(binary, contour_index)
+
+            if cache is not None:
+                cache.save_segmentation(page.cache_key, segmentation)
+
+        text_removed = remove_text(binary, segmentation, contour_index)
 
-    page.segmentation = segment(binary)
-    page.image_with_text_removed = remove_text(binary, page.segmentation)
+        if cache is not None:
+            cache.save_image(page.cache_key, "text_removed", text_removed)
+
+    page.segmentation = segmentation
+    page.image_with_text_removed = text_removed
     page.matches = prepare_matches_from_contours(
         page.image_with_text_removed,
         max_contour_width=page.segmentation.oligon_width * 1.5,
@@ -186,19 +709,37 @@ def prepare_matches_from_contours(
     max_contour_width=120,
     min_contour_height=5,
     max_contour_height=120,
+    contour_index=None,
 ):
-    contours = util.find_contours(image)
+    contour_index = util.get_contour_index(image, contour_index)
+
+    rects = contour_index.rects
+    widths = rects[:, 2]
+    heights = rects[:, 3]
+
+    candidates = (
+        (widths >= min_contour_width)
+        & (widths <= max_contour_width)
+        & (heights >= min_contour_height)
+        & (heights <= max_contour_height)
+    )
+
+    # The test images of the page share a single allocation, which is
+    # freed once no match refers to it any more
+    arena = np.zeros(
+        (np.count_nonzero(candidates), target_size, target_size), dtype=np.uint8
+    )
+    slot = 0
 
     contour_matches = []
 
-    # calculate bounding rectangles and enclosing circles for the contours
-    for c in contours:
+    for rect, (cx, cy, r) in zip(
+        contour_index.rects.tolist(), contour_index.circles.tolist()
+    ):
         match = ContourMatch()
 
-        # calculate bounding rectangles and enclosing circles for the contours
-        rect = cv2.boundingRect(c)
         match.bounding_rect = Rect(rect)
-        match.bounding_circle = Circle(cv2.minEnclosingCircle(c))
+        match.bounding_circle = Circle(((cx, cy), r))
 
         x, y, w, h = rect
 
@@ -217,103 +758,132 @@ def prepare_matches_from_contours(
             new_h = int(h * scale)
 
             if new_w > 0 and new_h > 0:
-                resized = cv2.resize(roi, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
-
-                tH, tW = resized.shape
-                dX = int(max(0, target_size - tW) / 2.0)
-                dY = int(max(0, target_size - tH) / 2.0)
-                # pad the image and force dimensions
-                padded = cv2.copyMakeBorder(
-                    resized,
-                    top=dY,
-                    bottom=dY,
-                    left=dX,
-                    right=dX,
-                    borderType=cv2.BORDER_CONSTANT,
-                    value=(0, 0, 0),
+                # Letterbox the crop into a square test image: scale it to fit,
+                # center it and force the dimensions with a single resize that
+                # writes directly into the zeroed arena slot
+                dX = int(max(0, target_size - new_w) / 2.0)
+                dY = int(max(0, target_size - new_h) / 2.0)
+
+                left, top, right, bottom = letterbox_content_box(
+                    (new_w, new_h), (dX, dY), target_size
                 )
-                padded = cv2.resize(
-                    padded, (target_size, target_size), interpolation=cv2.INTER_CUBIC
+
+                test_image = arena[slot]
+                cv2.resize(
+                    roi,
+                    (right - left, bottom - top),
+                    dst=test_image[top:bottom, left:right],
+                    interpolation=cv2.INTER_CUBIC,
                 )
 
-                match.test_image = padded
+                slot += 1
+
+                match.test_image = test_image
 
         contour_matches.append(match)
 
     return contour_matches
 
 
+def letterbox_content_box(resized_size, padding, target_size):
+    """
+    Returns the (left, top, right, bottom) box of a letterboxed test image
+    that is covered by the crop rather than by the padding. The crop is
+    resized to resized_size, padded by padding on each side, and the
+    result is stretched to target_size x target_size.
+    """
+    new_w, new_h = resized_size
+    dX, dY = padding
+
+    fx = target_size / (new_w + 2 * dX)
+    fy = target_size / (new_h + 2 * dY)
+
+    return (
+        round(dX * fx),
+        round(dY * fy),
+        round((dX + new_w) * fx),
+        round((dY + new_h) * fy),
+    )
+
+
 def assign_lines_to_matches(matches, baselines):
-    if len(baselines) == 0:
+    if len(baselines) == 0 or len(matches) == 0:
         return
 
-    for m in matches:
-        m.line = -1
+    baselines = np.asarray(baselines)
+    last = len(baselines) - 1
 
-        # First look for a baseline that overlaps the contour
-        for i, b in enumerate(baselines):
-            # If the baseline is inside the bounding box, we've found the line number
-            if m.bounding_rect.y <= b and b <= m.bounding_rect.y + m.bounding_rect.h:
-                m.line = i
-                break
+    tops = np.array([m.bounding_rect.y for m in matches])
+    bottoms = np.array([m.bounding_rect.y + m.bounding_rect.h for m in matches])
+    centers = np.array([m.bounding_circle.y for m in matches])
 
-        # If we assigned a line, move to the next contour
-        if m.line != -1:
-            continue
+    # First look for a baseline that overlaps the contour
+    lines = util.find_touching_lines(baselines, tops, bottoms)
 
-        # The neume is between two base lines.
-        for i, b in enumerate(baselines):
-            # The neume is either part of this baseline or the previous
-            if m.bounding_circle.y <= b:
-                if i == 0:
-                    m.line = i
-                    break
-
-                bp = baselines[i - 1]
-
-                # TODO if center is equidistant to each baseline, use entire bounding box
-                # to break the tie
-                if b - m.bounding_circle.y < m.bounding_circle.y - bp:
-                    m.line = i
-                    break
-                else:
-                    m.line = i - 1
-                    break
-
-        # If we assigned a line, move to the next contour
-        if m.line != -1:
-            continue
+    # Otherwise, the neume is between two baselines. Find the first
+    # baseline below the center, and assign the neume to whichever
+    # of that baseline and the previous one is closer.
+    # TODO if center is equidistant to each baseline, use entire bounding box
+    # to break the tie
+    below = np.searchsorted(baselines, centers, side="left")
+    next_baseline = baselines[np.minimum(below, last)]
+    previous_baseline = baselines[np.maximum(below - 1, 0)]
+
+    nearest = np.where(
+        next_baseline - centers < centers - previous_baseline, below, below - 1
+    )
+
+    # Neumes above the first baseline belong to the first baseline, and
+    # neumes below the last baseline belong to the last baseline
+    nearest = np.where(below == 0, 0, nearest)
+    nearest = np.where(below > last, last, nearest)
+
+    lines = np.where(lines == -1, nearest, lines)
 
-        # This neume must be part of the last baseline
-        if m.bounding_circle.y > baselines[len(baselines) - 1]:
-            m.line = len(baselines) - 1
+    for m, line in zip(matches, lines.tolist()):
+        m.line = line
 
 
 def sort_matches(matches):
     matches.sort(key=lambda p: (p.line, p.bounding_rect.x))
 
 
-def recognize_contours(matches, model, classes):
-    for m in matches:
-        if m.test_image is None or m.test_image.size == 0:
-            continue
+def recognize_contours(matches, model, classes, batch_size=64):
+    candidates = [
+        m for m in matches if m.test_image is not None and m.test_image.size != 0
+    ]
+
+    if batch_size <= 0:
+        batch_size = max(1, len(candidates))
+
+    buffer = None
+
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start : start + batch_size]
+
+        images = np.stack([m.test_image for m in batch])
 
-        img = cv2.cvtColor(m.test_image, cv2.COLOR_GRAY2RGB)
+        # Reuse the same (batch, channels, height, width) tensor for every batch
+        if buffer is None:
+            _, h, w = images.shape
+            buffer = np.empty((min(batch_size, len(candidates)), 3, h, w), np.float32)
 
-        img = transform(img)
+        tensor = transform_batch(images, out=buffer[: len(batch)])
 
-        output = model.run(["output"], {"input": img.astype(np.float32)})
+        output = model.run(["output"], {"input": tensor})
 
-        probabilities = np.exp(output[0][0]) / np.sum(np.exp(output[0][0]))  # Softmax
-        class_id = np.argmax(probabilities)
-        confidence = probabilities[class_id].item()
+        # Softmax
+        exp = np.exp(output[0])
+        probabilities = exp / np.sum(exp, axis=1, keepdims=True)
+        class_ids = np.argmax(probabilities, axis=1)
 
-        m.label = classes[class_id]
-        m.confidence = confidence
+        for m, p, class_id in zip(batch, probabilities, class_ids):
+            m.label = classes[class_id]
+            m.confidence = p[class_id].item()
 
-        # For debugging
-        # window_name = f"{m.label} ({m.confidence:0.2f})"
-        # cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
-        # cv2.imshow(window_name, m.test_image)
-        # cv2.waitKey()
-        # cv2.destroyAllWindows()
+            # For debugging
+            # window_name = f"{m.label} ({m.confidence:0.2f})"
+            # cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+            # cv2.imshow(window_name, m.test_image)
+            # cv2.waitKey()
+            # cv2.destroyAllWindows()
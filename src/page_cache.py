@@ -0,0 +1,253 @@
+"""
+Page cache
+
+This script contains an on-disk cache of the intermediate results of each
+page, so that rerunning a book only recomputes the stages whose inputs changed.
+A page is keyed by a hash of its pixels and the PreprocessOptions. For each
+key, the cache stores the artifacts of these stages:
+
+    binary              The preprocessed binary image
+    segmentation        The Segmentation of the binary image
+    text_removed        The binary image with the text removed, from which the
+                        contour crops are cut
+    recognition-<model> The label and confidence of each match, per model file
+
+Interpretation is not cached, since it is cheap and its rules change often.
+The least recently used artifacts are evicted once the cache is larger than
+its size limit.
+"""
+
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from segmentation import Segmentation
+
+# Change this when a change to the code makes the cached artifacts invalid
+CACHE_VERSION = 1
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PageCache:
+    """
+    An on-disk cache of page artifacts.
+
+    Parameters
+    ----------
+    directory: str
+        The folder the artifacts are stored in. It is created if needed, and
+        can be shared by several processes.
+
+    max_size: int
+        The size in bytes above which the least recently used artifacts are
+        evicted.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        # The size of the cache, counted the first time something is saved
+        self._size = None
+
+    def get_key(self, image, preprocess_options):
+        """
+        Returns the key of a page from its pixels and the options
+        used to preprocess it
+        """
+        h = hashlib.blake2b(digest_size=16)
+
+        h.update(f"{CACHE_VERSION}:{image.shape}:{image.dtype}".encode())
+        h.update(np.ascontiguousarray(image).data)
+        h.update(json.dumps(vars(preprocess_options), sort_keys=True).encode())
+
+        return h.hexdigest()
+
+    def load_image(self, key, stage):
+        data = self._read(key, f"{stage}.png")
+
+        if data is None:
+            return None
+
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    def save_image(self, key, stage, image):
+        _, data = cv2.imencode(".png", image)
+        self._write(key, f"{stage}.png", data.tobytes())
+
+    def load_segmentation(self, key):
+        data = self._read_json(key, "segmentation.json")
+
+        if data is None:
+            return None
+
+        segmentation = Segmentation()
+
+        for name, value in data.items():
+            setattr(segmentation, name, value)
+
+        return segmentation
+
+    def save_segmentation(self, key, segmentation):
+        self._write_json(key, "segmentation.json", vars(segmentation))
+
+    def get_model_key(self, model_path, metadata):
+        """
+        Returns the key of a model from the SHA-256 checksum of its
+        file and its version, so that a different model file with the
+        same version does not reuse the recognition of another
+        """
+        stat = os.stat(model_path)
+        checksum = get_file_sha256(
+            os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns
+        )
+
+        return f"{metadata.model_version}:{checksum}"
+
+    def load_recognition(self, key, model_key):
+        """
+        Returns the (labels, confidences) of the matches of a page,
+        as recognized by the given model, or None
+        """
+        data = self._read_json(key, self._get_recognition_name(model_key))
+
+        if data is None:
+            return None
+
+        return data["labels"], data["confidences"]
+
+    def save_recognition(self, key, model_key, matches):
+        self._write_json(
+            key,
+            self._get_recognition_name(model_key),
+            {
+                "labels": [m.label for m in matches],
+                "confidences": [m.confidence for m in matches],
+            },
+        )
+
+    def _get_recognition_name(self, model_key):
+        model_hash = hashlib.blake2b(model_key.encode(), digest_size=8).hexdigest()
+        return f"recognition-{model_hash}.json"
+
+    def _get_path(self, key, name):
+        return self.directory / key[:2] / f"{key}.{name}"
+
+    def _read(self, key, name):
+        path = self._get_path(key, name)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+            # Mark the artifact as recently used
+            os.utime(path)
+        except OSError:
+            # Another process may have evicted it
+            return None
+
+        return data
+
+    def _read_json(self, key, name):
+        data = self._read(key, name)
+
+        if data is None:
+            return None
+
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def _write(self, key, name, data):
+        path = self._get_path(key, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so that other
+        # processes never read a partial artifact
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+
+            os.replace(temp_path, path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+        if self._size is None:
+            self._size = self.get_size()
+        else:
+            self._size += len(data)
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _write_json(self, key, name, data):
+        self._write(key, name, json.dumps(data).encode("utf-8"))
+
+    def get_size(self):
+        return sum(size for _, _, size in self._list_artifacts())
+
+    def evict(self):
+        """
+        Deletes the least recently used artifacts until the
+        cache fits in 90% of its size limit
+        """
+        artifacts = sorted(self._list_artifacts())
+        size = sum(size for _, _, size in artifacts)
+
+        for _, path, artifact_size in artifacts:
+            if size <= self.max_size * 0.9:
+                break
+
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+            size -= artifact_size
+
+        self._size = size
+
+    def _list_artifacts(self):
+        """
+        Returns a (last used time, path, size) tuple for each artifact
+        """
+        artifacts = []
+
+        for path in self.directory.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+
+            artifacts.append((stat.st_mtime, path, stat.st_size))
+
+        return artifacts
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_sha256(path, size, mtime):
+    """
+    Returns the SHA-256 checksum of a file. The size and modification time
+    are part of the cache key, so that a changed file is hashed again.
+    """
+    sha256 = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
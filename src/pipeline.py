@@ -0,0 +1,112 @@
+"""
+Pipeline
+
+This script contains a small utility for running work in a pipeline of
+stages, where each stage runs in its own thread and the stages are connected
+by bounded queues.
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def run_pipeline(items, stages, queue_size=2):
+    """
+    Runs items through a pipeline of stages.
+
+    Parameters
+    ----------
+    items: iterable
+        The items to feed to the first stage.
+
+    stages: list
+        A list of functions. Each function takes one item and returns an iterable
+        of zero or more items for the next stage.
+
+    queue_size: int
+        The maximum number of items waiting between two stages. This bounds
+        the number of items in flight.
+
+    Returns
+    -------
+    generator
+        The items produced by the last stage, in order.
+    """
+    stop = threading.Event()
+    errors = []
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+
+                queues[0].put(item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            queues[0].put(_DONE)
+
+    def work(stage, inbox, outbox):
+        try:
+            while True:
+                item = inbox.get()
+
+                if item is _DONE:
+                    break
+
+                # If another stage failed, keep draining the queue
+                # so that the upstream stages do not block
+                if stop.is_set():
+                    continue
+
+                try:
+                    for result in stage(item):
+                        outbox.put(result)
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+        finally:
+            outbox.put(_DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+
+    for i, stage in enumerate(stages):
+        threads.append(
+            threading.Thread(
+                target=work, args=(stage, queues[i], queues[i + 1]), daemon=True
+            )
+        )
+
+    for t in threads:
+        t.start()
+
+    item = None
+
+    try:
+        while True:
+            item = queues[-1].get()
+
+            if item is _DONE:
+                break
+
+            if not stop.is_set():
+                yield item
+    finally:
+        # If the consumer stopped early, drain the last queue
+        # so that the stages can finish
+        stop.set()
+
+        while item is not _DONE:
+            item = queues[-1].get()
+
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,20 @@
+# "rotate" scores each candidate angle by rotating the full page.
+# "fast" uses a coarse-to-fine search with shear-based projection profiles.
+DESKEW_STRATEGIES = ["rotate", "fast"]
+
+
+class PreprocessOptions:
+    def __init__(self):
+        self.deskew = True
+        self.deskew_max_angle = 5
+        self.deskew_initial_delta = 1
+        self.deskew_strategy = "rotate"
+        self.despeckle = True
+        self.despeckle_kernel_size = 3
+        self.close = True
+        self.close_kernel_size = 2
+        # The highest DPI at which PDF pages are rendered. Pages that would be
+        # larger than the downsize target are rendered at a lower DPI instead.
+        self.pdf_dpi = 300
+        # Use the embedded image of scanned PDF pages instead of rendering them
+        self.pdf_extract_images = False
@@ -10,7 +10,6 @@ import math
 
 import cv2
 import numpy as np
-from scipy import signal, stats
 
 import util
 
@@ -54,7 +53,7 @@ textlines_adj: {self.textlines_adj}
         }
 
 
-def segment(binary_image):
+def segment(binary_image, contour_index=None):
     """
     Segments an image
 
@@ -63,6 +62,9 @@ def segment(binary_image):
     binary_image: MatLike
         The image to segment. Must be binary.
 
+    contour_index: ContourIndex, optional
+        The contours of `binary_image`. If omitted, they are found here.
+
     Returns
     -------
     Segmentation
@@ -73,13 +75,15 @@ def segment(binary_image):
     result.page_height = binary_image.shape[0]
     result.page_width = binary_image.shape[1]
 
-    wide_contours = find_wide_contours(binary_image)
+    contour_index = util.get_contour_index(binary_image, contour_index)
+
+    wide_contours = find_wide_contours(binary_image, contour_index=contour_index)
 
     result.oligon_height = find_oligon_height(binary_image, wide_contours)
 
     result.oligon_width = find_oligon_width(wide_contours, result.oligon_height)
 
-    find_baselines(binary_image, result)
+    find_baselines(binary_image, result, contour_index=contour_index)
 
     # Re-estimate the oligon height and width using only contours that
     # 1) touch the baseline
@@ -100,15 +104,17 @@ def segment(binary_image):
     result.oligon_height = find_oligon_height(binary_image, wide_contours)
     result.oligon_width = find_oligon_width(wide_contours, result.oligon_height)
 
-    find_textlines(binary_image, result)
-    find_adjusted_textlines(binary_image, result)
+    find_textlines(binary_image, result, contour_index=contour_index)
+    find_adjusted_textlines(binary_image, result, contour_index=contour_index)
 
-    result.avg_text_height = find_average_text_height(binary_image, result.textlines)
+    result.avg_text_height = find_average_text_height(
+        binary_image, result.textlines, contour_index=contour_index
+    )
 
     return result
 
 
-def find_wide_contours(binary_image, cutoff_ratio=3.0):
+def find_wide_contours(binary_image, cutoff_ratio=3.0, contour_index=None):
     """
     Finds contours in a binary image that satisfy width/height >= cutoff_ratio.
 
@@ -120,18 +126,19 @@ def find_wide_contours(binary_image, cutoff_ratio=3.0):
     cutoff_ratio: float
         The cutoff ratio to use
 
+    contour_index: ContourIndex, optional
+        The contours of `binary_image`. If omitted, they are found here.
+
     Returns
     -------
     list
         A list of wide contours
     """
-    contours = util.find_contours(binary_image)
+    contour_index = util.get_contour_index(binary_image, contour_index)
 
     wide_contours = list()
 
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-
+    for c, (x, y, w, h) in zip(contour_index.contours, contour_index.rects.tolist()):
         if w / h >= cutoff_ratio:
             wide_contours.append(c)
 
@@ -155,21 +162,26 @@ def find_oligon_height(binary_image, wide_contours):
     int
         The estimated height of the oligon
     """
-    heights = list()
+    histogram = np.zeros(1, dtype=np.int64)
 
     for c in wide_contours:
         x, y, w, h = cv2.boundingRect(c)
 
         roi = binary_image[y : y + h, x : x + w]
 
-        runs = util.vertical_runs(roi, 255)
+        runs = util.vertical_run_histogram(roi, 255)
 
-        heights.extend(runs)
+        if len(runs) > len(histogram):
+            runs[: len(histogram)] += histogram
+            histogram = runs
+        else:
+            histogram[: len(runs)] += runs
 
-    if len(heights) == 0:
+    if histogram.sum() == 0:
         return 0
 
-    return stats.mode(heights)[0].item()
+    # The most frequent run length. Ties go to the shortest run.
+    return int(np.argmax(histogram))
 
 
 def find_oligon_width(wide_contours, oligon_height):
@@ -205,18 +217,16 @@ def find_oligon_width(wide_contours, oligon_height):
     return int(np.median(widths))
 
 
-def find_average_text_height(image, textlines):
+def find_average_text_height(image, textlines, contour_index=None):
     """
     Finds the average height of all contours that touch textlines
     """
-    contours = util.find_contours(image)
+    contour_index = util.get_contour_index(image, contour_index)
 
     heights = list()
 
     # Find the height of each contour that touches a textline
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-
+    for x, y, w, h in contour_index.rects.tolist():
         if any(y <= line and line <= y + h for line in textlines):
             heights.append(h)
 
@@ -228,14 +238,23 @@ def find_average_text_height(image, textlines):
 
 
 def find_baselines(
-    binary_image, segmentation, narrow_contour_cutoff=2.0, min_contour_height=5
+    binary_image,
+    segmentation,
+    narrow_contour_cutoff=2.0,
+    min_contour_height=5,
+    contour_index=None,
 ):
+    # scipy is slow to import, so it is only imported when needed
+    from scipy import signal
+
     if segmentation.oligon_width <= 1:
         # Something has gone horribly wrong
         segmentation.baselines = []
         return
 
-    masked = util.mask_narrow_contours(binary_image, narrow_contour_cutoff)
+    masked = util.mask_narrow_contours(
+        binary_image, narrow_contour_cutoff, contour_index
+    )
     masked = util.mask_thin_contours(masked, min_contour_height)
     masked = util.mask_wide_contours(masked, segmentation.oligon_width * 10)
 
@@ -314,10 +333,14 @@ def find_baselines(
     segmentation.baselines = pruned
 
 
-def find_textlines(binary_image, segmentation, min_contour_height=5):
+def find_textlines(
+    binary_image, segmentation, min_contour_height=5, contour_index=None
+):
     """
     Finds texts textlines by finding the rows with the most black pixels that appear between baselines
     """
+    from scipy import signal
+
     textlines = list()
 
     if segmentation.oligon_width == 0:
@@ -333,7 +356,7 @@ def find_textlines(binary_image, segmentation, min_contour_height=5):
 
     # Mask thin contour so that we don't detect melismatic underscores as textlines.
     # We want the textline to run through the letters, not the melismas.
-    masked = util.mask_thin_contours(binary_image, min_contour_height)
+    masked = util.mask_thin_contours(binary_image, min_contour_height, contour_index)
     masked = util.mask_wide_contours(masked, segmentation.oligon_width * 10)
 
     # Find the number of pixels in each row.
@@ -393,16 +416,15 @@ def find_textlines(binary_image, segmentation, min_contour_height=5):
     segmentation.textlines = textlines
 
 
-def find_adjusted_textlines(image, segmentation):
-    contours = util.find_contours(image)
+def find_adjusted_textlines(image, segmentation, contour_index=None):
+    contour_index = util.get_contour_index(image, contour_index)
+
+    rects = contour_index.rects.tolist()
 
     textlines_adj = []
     for line in segmentation.textlines:
         midpoints = []
-        for c in contours:
-            rect = cv2.boundingRect(c)
-            x, y, w, h = rect
-
+        for x, y, w, h in rects:
             if y <= line and line <= y + h:
                 midpoints.append(y + h / 2)
 
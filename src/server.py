@@ -0,0 +1,129 @@
+"""
+Server
+
+This script contains a small HTTP server that keeps the model loaded between
+OCR jobs. Jobs run in a bounded pool of worker processes, each of which loads
+the model once when it starts. See jobs.py.
+
+Send a job with a POST request to /ocr. The body is a JSON object with the
+same options as the headless command line, e.g.
+
+    {"input": "book.pdf", "start_page": 3, "end_page": 5, "split_lr": true}
+
+The response is the analysis in the requested format (YAML by default).
+"""
+
+import json
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jobs import JobError, create_job_executor, run_job_in_worker
+
+CONTENT_TYPES = {
+    "yaml": "application/yaml; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+    "msgpack": "application/msgpack",
+}
+
+
+class OCRServer(ThreadingHTTPServer):
+    """
+    An HTTP server that runs OCR jobs in a pool of worker processes.
+
+    Parameters
+    ----------
+    address: tuple
+        The (host, port) to listen on.
+
+    create_job: function
+        Turns the JSON object of a request into an OCRJob. Raises a JobError
+        if the request is invalid.
+
+    model_path: str
+        The path of the ONNX model loaded by each worker.
+
+    metadata_path: str
+        The path of the model metadata loaded by each worker.
+
+    inference_options: InferenceOptions
+        The options used to load the model in each worker.
+
+    workers: int
+        The number of jobs that can run at the same time. Other jobs wait
+        until a worker is free.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        create_job,
+        model_path,
+        metadata_path,
+        inference_options,
+        workers=1,
+    ):
+        super().__init__(address, OCRRequestHandler)
+
+        self.create_job = create_job
+        self.executor = create_job_executor(
+            model_path, metadata_path, inference_options, workers
+        )
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class OCRRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_text(404, "Not found")
+            return
+
+        self.send_text(200, "ok")
+
+    def do_POST(self):
+        if self.path != "/ocr":
+            self.send_text(404, "Not found")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            if not isinstance(request, dict):
+                raise JobError("The request body must be a JSON object.")
+
+            job = self.server.create_job(request)
+        except (JobError, ValueError) as e:
+            self.send_text(400, str(e))
+            return
+
+        try:
+            result = self.server.executor.submit(run_job_in_worker, job).result()
+        except JobError as e:
+            self.send_text(400, str(e))
+            return
+        except Exception:
+            self.send_text(500, traceback.format_exc())
+            return
+
+        if isinstance(result, str):
+            result = result.encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[job.output_format])
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def send_text(self, status, text):
+        body = text.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
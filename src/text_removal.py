@@ -1,28 +1,43 @@
 import cv2
+import numpy as np
 
 import util
 
 
-def find_text_contours(image, segmentation, min_contour_height=5):
-    contours = util.find_contours(image)
+def find_text_contours(image, segmentation, min_contour_height=5, contour_index=None):
+    contour_index = util.get_contour_index(image, contour_index)
 
-    text_contours = find_outlying_contours(contours, segmentation)
+    return [
+        contour_index.contours[i]
+        for i in find_text_contour_indices(
+            contour_index, segmentation, min_contour_height
+        )
+    ]
+
+
+def find_text_contour_indices(contour_index, segmentation, min_contour_height=5):
+    """
+    Returns the indexes of the contours in `contour_index` that are probably text
+    """
+    rects = contour_index.rects.tolist()
+
+    text_contours = find_outlying_contours(contour_index, segmentation)
 
     baseline_rects = list()
 
     # Find the bounding rectangles for each contour that overlaps a baseline
-    for c in contours:
-        rect = cv2.boundingRect(c)
+    for rect in rects:
         x, y, w, h = rect
 
         if any(y <= line and line <= y + h for line in segmentation.baselines):
             baseline_rects.append(rect)
 
+    baseline_grid = util.RectGrid(baseline_rects)
+    grid = util.RectGrid(rects)
+
     # Preserve contours that may be martyria, agogi,
     # or neumes that dip into the text line
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-
+    for i, (x, y, w, h) in enumerate(rects):
         textline = -1
 
         # Find contours that touch the textline +- avg_height / 2
@@ -49,7 +64,7 @@ def find_text_contours(image, segmentation, min_contour_height=5):
         # If the textline is before the first baseline, then this is a heading
         # and should be removed. That is, it's a title or mode key signature, etc.
         if textline < segmentation.baselines[0]:
-            text_contours.append(c)
+            text_contours.append(i)
             continue
 
         # Check for neumes that are more than twice as wide as they are tall.
@@ -79,12 +94,11 @@ def find_text_contours(image, segmentation, min_contour_height=5):
         # Search for contours above the baseline
         found_contour_on_baseline = False
 
-        for (
-            baseline_rect_x,
-            baseline_rect_y,
-            baseline_rect_w,
-            baseline_rect_h,
-        ) in baseline_rects:
+        for j in baseline_grid.query(x, baseline, x + w, baseline):
+            baseline_rect_x, baseline_rect_y, baseline_rect_w, baseline_rect_h = (
+                baseline_rects[j]
+            )
+
             # If the contour touches this baseline...
             if (
                 baseline_rect_y <= baseline
@@ -106,10 +120,8 @@ def find_text_contours(image, segmentation, min_contour_height=5):
 
             # Check to see whether there is a contour above this one
             # that satisfies certain criteria
-            for inner_c in contours:
-                other_rect_x, other_rect_y, other_rect_w, other_rect_h = (
-                    cv2.boundingRect(inner_c)
-                )
+            for j in grid.query(x, y - 1.5 * segmentation.avg_text_height, x + w, y):
+                other_rect_x, other_rect_y, other_rect_w, other_rect_h = rects[j]
 
                 # If the contour is above the other one...
                 if other_rect_y < y:
@@ -134,12 +146,10 @@ def find_text_contours(image, segmentation, min_contour_height=5):
 
         # If we got this far, the contour is probably text and should be removed.
         # Mask the contour by drawing a filled rectangle over it
-        text_contours.append(c)
+        text_contours.append(i)
 
     # Find melismas
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-
+    for i, (x, y, w, h) in enumerate(rects):
         for line in segmentation.textlines_adj:
             if (
                 h <= min_contour_height
@@ -147,76 +157,60 @@ def find_text_contours(image, segmentation, min_contour_height=5):
                 and line <= y
                 and y <= line + segmentation.avg_text_height
             ):
-                text_contours.append(c)
+                text_contours.append(i)
 
     return text_contours
 
 
-def find_outlying_contours(contours, segmentation):
-    far_away_contours = []
-
+def find_outlying_contours(contour_index, segmentation):
+    """
+    Returns the indexes of the contours in `contour_index` that are far away from every baseline
+    """
     tolerance = segmentation.avg_baseline_gap
 
     if len(segmentation.baselines) == 0:
-        return far_away_contours
+        return []
 
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-        (cx, cy), r = cv2.minEnclosingCircle(c)
+    baselines = np.asarray(segmentation.baselines)
+    last = len(baselines) - 1
 
-        done = False
+    rects = contour_index.rects
+    centers = contour_index.circles[:, 1]
 
-        # First look for a baseline that overlaps the contour
-        for i, b in enumerate(segmentation.baselines):
-            # If the baseline is inside the bounding box, then this contour is on a baseline
-            if y <= b and b <= y + h:
-                done = True
-                break
-
-        # Skip to the next contour. We only care about contours that are far away from baselines
-        if done:
-            continue
+    # Contours that touch a baseline are never far away
+    on_baseline = (
+        util.find_touching_lines(baselines, rects[:, 1], rects[:, 1] + rects[:, 3])
+        != -1
+    )
 
-        # The neume is between two base lines.
-        for i, b in enumerate(segmentation.baselines):
-            # The neume is either part of this baseline or the previous
-            if cy <= b:
-                if i == 0:
-                    if b - cy > tolerance:
-                        far_away_contours.append(c)
-                        done = True
-                    break
+    # The neume is between two base lines. Find the first baseline below the center.
+    below = np.searchsorted(baselines, centers, side="left")
+    next_baseline = baselines[np.minimum(below, last)]
+    previous_baseline = baselines[np.maximum(below - 1, 0)]
 
-                bp = segmentation.baselines[i - 1]
+    # If the contour is too far away from either baseline, it's probably in
+    # a text region between baselines
+    far_away = (next_baseline - centers > tolerance) & (
+        centers - previous_baseline > tolerance
+    )
 
-                # If the contour is too far away from either baseline, it's probably in
-                # a text region between baselines, so we skip i
-                if b - cy > tolerance and cy - bp > tolerance:
-                    far_away_contours.append(c)
-                    done = True
-                    break
-
-        if done:
-            continue
+    # Above the first baseline, only the first baseline counts.
+    # Below the last baseline, only the last baseline counts.
+    far_away = np.where(below == 0, next_baseline - centers > tolerance, far_away)
+    far_away = np.where(below > last, centers - baselines[last] > tolerance, far_away)
 
-        # This neume must be part of the last baseline,
-        # unless it is too far away from the last baseline
-        if (
-            cy > segmentation.baselines[len(segmentation.baselines) - 1]
-            and cy - segmentation.baselines[len(segmentation.baselines) - 1] > tolerance
-        ):
-            far_away_contours.append(c)
+    return np.flatnonzero(far_away & ~on_baseline).tolist()
 
-    return far_away_contours
 
+def remove_text(image, segmentation, contour_index=None):
+    contour_index = util.get_contour_index(image, contour_index)
 
-def remove_text(image, segmentation):
-    contours = find_text_contours(image, segmentation)
+    text_contours = find_text_contour_indices(contour_index, segmentation)
 
     copy = image.copy()
 
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
+    for i in text_contours:
+        x, y, w, h = contour_index.rects[i].tolist()
         cv2.rectangle(copy, (x, y), (x + w, y + h), (0, 0, 0), cv2.FILLED)
 
     return copy
@@ -1,9 +1,9 @@
 import math
+from collections import defaultdict
 
 import cv2
 import imutils
 import numpy as np
-from scipy.ndimage import rotate
 
 
 def to_binary(image):
@@ -22,13 +22,89 @@ def find_contours(image):
     return contours
 
 
-def apply_mask(image, condition):
-    copy = image.copy()
-    contours = find_contours(copy)
+class ContourIndex:
+    """
+    Finds the contours of an image once and caches their bounding rectangles
+    and enclosing circles, so that several passes over the same image can share them.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.contours = find_contours(image)
+
+        # (N, 4) array of (x, y, w, h)
+        self.rects = np.array(
+            [cv2.boundingRect(c) for c in self.contours], dtype=np.int64
+        ).reshape(-1, 4)
+
+        self._circles = None
+
+    @property
+    def circles(self):
+        """
+        (N, 3) array of (x, y, r) for the minimum enclosing circle of each contour
+        """
+        if self._circles is None:
+            self._circles = np.array(
+                [(x, y, r) for (x, y), r in map(cv2.minEnclosingCircle, self.contours)],
+                dtype=np.float64,
+            ).reshape(-1, 3)
+
+        return self._circles
+
+
+def get_contour_index(image, contour_index=None):
+    """
+    Returns `contour_index` if it was built from `image`. Otherwise, builds a new index.
+    """
+    if contour_index is not None and contour_index.image is image:
+        return contour_index
+
+    return ContourIndex(image)
+
+
+class RectGrid:
+    """
+    A uniform grid over a list of (x, y, w, h) rectangles, for finding the rectangles
+    near a region without testing every rectangle.
+    """
 
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
+    def __init__(self, rects, cell_size=64):
+        self.rects = rects
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
 
+        for i, (x, y, w, h) in enumerate(rects):
+            for cx in range(x // cell_size, (x + w) // cell_size + 1):
+                for cy in range(y // cell_size, (y + h) // cell_size + 1):
+                    self.cells[(cx, cy)].append(i)
+
+    def query(self, left, top, right, bottom):
+        """
+        Returns the indexes of the rectangles that share a cell with the region.
+        This includes every rectangle that touches the region, but the caller must
+        still test the rectangles exactly.
+        """
+        found = set()
+
+        for cx in range(
+            math.floor(left / self.cell_size), math.floor(right / self.cell_size) + 1
+        ):
+            for cy in range(
+                math.floor(top / self.cell_size),
+                math.floor(bottom / self.cell_size) + 1,
+            ):
+                found.update(self.cells.get((cx, cy), ()))
+
+        return found
+
+
+def apply_mask(image, condition, contour_index=None):
+    contour_index = get_contour_index(image, contour_index)
+
+    copy = image.copy()
+
+    for x, y, w, h in contour_index.rects.tolist():
         if condition(x, y, w, h):
             # Mask the contour by drawing a filled rectangle over it
             cv2.rectangle(copy, (x, y), (x + w, y + h), (0, 0, 0), cv2.FILLED)
@@ -36,61 +112,88 @@ def apply_mask(image, condition):
     return copy
 
 
-def mask_thin_contours(binary_image, cutoff):
+def mask_thin_contours(binary_image, cutoff, contour_index=None):
     """
     Returns a binary representation of the image with thin contours removed. Contours height <= cutoff are removed.
     """
-    return apply_mask(binary_image, lambda x, y, w, h: h <= cutoff)
+    return apply_mask(binary_image, lambda x, y, w, h: h <= cutoff, contour_index)
 
 
-def mask_wide_contours(binary_image, cutoff):
+def mask_wide_contours(binary_image, cutoff, contour_index=None):
     """
     Returns a binary representation of the image with thin contours removed. Contours width >= cutoff are removed.
     """
-    return apply_mask(binary_image, lambda x, y, w, h: w >= cutoff)
+    return apply_mask(binary_image, lambda x, y, w, h: w >= cutoff, contour_index)
 
 
-def mask_narrow_contours(binary_image, cutoff_ratio):
+def mask_narrow_contours(binary_image, cutoff_ratio, contour_index=None):
     """
     Returns a binary representation of the image with narrow contours removed. Contours with width/height <= cutoff_ratio are removed.
     """
-    return apply_mask(binary_image, lambda x, y, w, h: w / h <= cutoff_ratio)
+    return apply_mask(
+        binary_image, lambda x, y, w, h: w / h <= cutoff_ratio, contour_index
+    )
 
 
-def vertical_runs(image, color):
-    runs = list()
+def find_touching_lines(lines, tops, bottoms):
+    """
+    For each (top, bottom) pair, returns the index of the first line such that
+    top <= line <= bottom, or -1 if there is no such line. `lines` must be sorted.
+    """
+    lines = np.asarray(lines)
+    tops = np.asarray(tops)
+    bottoms = np.asarray(bottoms)
 
-    current_run = 0
+    if len(lines) == 0:
+        return np.full(len(tops), -1)
 
-    rows, cols = image.shape
+    # The first line that is not above the top
+    first = np.searchsorted(lines, tops, side="left")
+    touching = (first < len(lines)) & (
+        lines[np.minimum(first, len(lines) - 1)] <= bottoms
+    )
 
-    for col in range(cols):
-        for row in range(rows):
-            if image[row, col] == color:
-                current_run = current_run + 1
-            elif current_run != 0:
-                runs.append(current_run)
-                current_run = 0
+    return np.where(touching, first, -1)
 
-        if current_run != 0:
-            runs.append(current_run)
-            current_run = 0
 
-    return runs
+def vertical_runs(image, color):
+    """
+    Returns the lengths of the vertical runs of `color`, column by column
+    """
+    # Transpose so that each column becomes a row, and pad each row with a zero
+    # on both ends so that every run has a start and an end
+    mask = np.zeros((image.shape[1], image.shape[0] + 2), dtype=np.int8)
+    mask[:, 1:-1] = (image == color).T
 
+    edges = np.diff(mask, axis=1).ravel()
 
-def pixels_in_row(binary_image):
-    pixels_in_row = list()
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
 
-    rows, _ = binary_image.shape
+    return ends - starts
 
-    for r in range(rows):
-        pixels_in_row.append(cv2.countNonZero(binary_image[r, :]))
 
-    return pixels_in_row
+def vertical_run_histogram(image, color):
+    """
+    Returns a histogram of the vertical run lengths of `color`,
+    where histogram[n] is the number of runs of length n
+    """
+    return np.bincount(vertical_runs(image, color))
+
+
+def pixels_in_row(binary_image):
+    """
+    Returns an array containing the number of non-zero pixels in each row.
+    The image must only contain the values 0 and 255.
+    """
+    row_sums = cv2.reduce(binary_image, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+    return row_sums.ravel() // 255
 
 
 def find_skew_angles(binary_image, limit, delta):
+    # scipy is slow to import, so it is only imported when needed
+    from scipy.ndimage import rotate
+
     def determine_score(arr, angle):
         data = rotate(arr, angle, reshape=False, order=0)
         histogram = np.sum(data, axis=1, dtype=float)
@@ -127,6 +230,8 @@ def gss_max(f, a, b, tolerance=1e-5):
 
 
 def deskew(img, limit, delta):
+    from scipy.ndimage import rotate
+
     binary_image = to_binary(img)
 
     sorted_angles = find_skew_angles(binary_image, limit, delta)
@@ -142,17 +247,78 @@ def deskew(img, limit, delta):
 
     best_angle = gss_max(determine_score, lower_limit, upper_limit, 0.1)
 
+    return best_angle, rotate_image(img, best_angle)
+
+
+def projection_score(ys, xs, angle, weights=None):
+    """
+    Scores how sharp the horizontal projection profile of the ink pixels at (ys, xs)
+    is after correcting for `angle`. The rotation is approximated by a shear, which is
+    accurate for small angles and only needs the ink pixels rather than the whole image.
+    """
+    if len(ys) == 0:
+        return 0.0
+
+    rows = np.rint(ys - np.tan(np.radians(angle)) * xs).astype(np.int64)
+    histogram = np.bincount(rows - rows.min(), weights=weights)
+    return np.sum(np.diff(histogram) ** 2, dtype=float)
+
+
+def deskew_fast(img, limit, delta, scale=4):
+    """
+    A faster version of `deskew`. Searches for the best angle on a downsampled image
+    first, and then refines it at full resolution near that angle. Angles are scored
+    with shear-based projection profiles instead of full rotations.
+    """
+    binary_image = to_binary(img)
+
+    h, w = binary_image.shape
+
+    # Coarse search on a downsampled image
+    small = cv2.resize(
+        binary_image,
+        (max(1, w // scale), max(1, h // scale)),
+        interpolation=cv2.INTER_AREA,
+    )
+
+    ys, xs = np.nonzero(small)
+    weights = small[ys, xs].astype(float)
+    xs = xs - small.shape[1] / 2
+
+    angles = np.arange(-limit, limit + delta, delta)
+    scores = [projection_score(ys, xs, angle, weights) for angle in angles]
+
+    coarse_angle = angles[np.argmax(scores)]
+
+    # Refine at full resolution
+    ys, xs = np.nonzero(binary_image)
+    xs = xs - w / 2
+
+    best_angle = gss_max(
+        lambda angle: projection_score(ys, xs, angle),
+        coarse_angle - delta,
+        coarse_angle + delta,
+        0.1,
+    )
+
+    return best_angle, rotate_image(img, best_angle)
+
+
+def rotate_image(img, angle):
     h, w = img.shape[:2]
     center = (w // 2, h // 2)
-    M = cv2.getRotationMatrix2D(center, best_angle, 1.0)
-    corrected = cv2.warpAffine(
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(
         img, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
     )
 
-    return best_angle, corrected
+
+# The largest page that is processed. Larger pages are downsized.
+DOWNSIZE_MAX_WIDTH = 2550
+DOWNSIZE_MAX_HEIGHT = 3300
 
 
-def downsize(image, max_width=2550, max_height=3300):
+def downsize(image, max_width=DOWNSIZE_MAX_WIDTH, max_height=DOWNSIZE_MAX_HEIGHT):
     h, w = image.shape[:2]
     if w > max_width or h > max_height:
         scaling_factor = min(max_width / w, max_height / h)